@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+__author__ = 'schneg'
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import date
+
+from db_writer import SqliteWriter
+from delays import TripDelays
+from generate_feed import generate_feed
+from make_database import (
+    build_database,
+    compress_stop_times_table,
+    read_stop_times_table,
+)
+from make_schedule import parse
+from profiling import BuildProfile
+from stop_queries import (
+    PatternCache,
+    find_arrivals,
+    find_boards,
+    load_string_ids,
+    load_trip_ids,
+)
+
+# Times the build and query paths on synthetic feeds from generate_feed.py and compares them with a saved baseline.
+#
+#   python benchmark.py --save baseline.json
+#   (make changes)
+#   python benchmark.py --baseline baseline.json
+#
+# exits with status 1 if anything got slower than the tolerance allows.
+
+RESULTS_VERSION = 1
+
+# name -> generate_feed arguments
+SCALES = OrderedDict([
+    ("small", dict(routes=10, trips_per_route=100, stops_per_trip=20)),
+    ("medium", dict(routes=40, trips_per_route=200, stops_per_trip=30)),
+    ("large", dict(routes=150, trips_per_route=300, stops_per_trip=40)),
+])
+
+# phases of make_database.build_database which write tables, the rest is compress_stop_times
+WRITE_PHASES = ["trip_ids", "route_ids", "services", "stop_times", "arrivals", "stop_ids", "trip_stops",
+                "stop_patterns", "commit"]
+
+# a Wednesday which isn't a holiday in generate_feed
+QUERY_DATE = date(2026, 3, 4)
+QUERY_STOPS = 25
+# the window for query_window, 8:00 to 9:30
+QUERY_WINDOW = 8 * 3600, 9 * 3600 + 30 * 60
+
+# Each benchmark is given the feed directory and a scratch directory and does its setup, then returns
+# a function to time. That function returns (rows, seconds), where seconds is None to use its own wall time.
+# Peak memory is for a whole call of that function, setup not included.
+
+def bench_read_stop_times(feed_path, scratch):
+    csv_path = os.path.join(feed_path, "stop_times.txt")
+    def run():
+        table = read_stop_times_table(csv_path)
+        return sum(len(lst) for lst in table.values()), None
+    return run
+
+def bench_compress_stop_times(feed_path, scratch):
+    table = read_stop_times_table(os.path.join(feed_path, "stop_times.txt"))
+    rows = sum(len(lst) for lst in table.values())
+    def run():
+        compress_stop_times_table(table)
+        return rows, None
+    return run
+
+def bench_write_tables(feed_path, scratch):
+    db_path = os.path.join(scratch, "benchmark.db")
+    def run():
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        profile = BuildProfile()
+        writer = SqliteWriter(db_path)
+        try:
+            build_database(feed_path, writer, profile=profile)
+        finally:
+            writer.close()
+        seconds = sum(phase["wall_seconds"] for phase in profile.phases if phase["name"] in WRITE_PHASES)
+        return writer.rows_written, seconds
+    return run
+
+def bench_schedule_compress(feed_path, scratch):
+    def run():
+        profile = BuildProfile()
+        # parse prints its progress
+        with contextlib.redirect_stdout(io.StringIO()):
+            parse(feed_path, profile=profile)
+        phases = dict((phase["name"], phase) for phase in profile.phases)
+        return phases["read_stop_times"]["rows"], phases["compress"]["wall_seconds"]
+    return run
+
+def bench_query(feed_path, scratch):
+    db_path = os.path.join(scratch, "query.db")
+    if not os.path.exists(db_path):
+        writer = SqliteWriter(db_path)
+        try:
+            build_database(feed_path, writer)
+        finally:
+            writer.close()
+
+    con = sqlite3.connect(db_path)
+    cur = con.cursor()
+    stop_ids = load_string_ids(cur, "stop_ids", "stop_id")
+    stops = stop_ids[::max(1, len(stop_ids) // QUERY_STOPS)]
+    # pretend every trip is in the realtime feed, with a delay at the start of each
+    trip_ids = [str(trip_id) for trip_id, in cur.execute("SELECT trip_id FROM trip_ids")]
+    trip_id_to_delays = dict((trip_id, TripDelays([(1, (i % 7) * 30)])) for i, trip_id in enumerate(trip_ids))
+
+    def run():
+        route_ids = load_string_ids(cur, "route_ids", "route_id")
+        load_trip_ids(cur, trip_ids)
+        patterns = PatternCache()
+        rows = 0
+        for stop_id in stops:
+            rows += len(find_arrivals(cur, stop_id, None, trip_id_to_delays, QUERY_DATE, route_ids, patterns))
+        return rows, None
+    run.setup = cur, stops, trip_ids, trip_id_to_delays
+    return run
+
+def bench_query_boards(feed_path, scratch):
+    """The same lookups as bench_query, all stops at once"""
+    run_single = bench_query(feed_path, scratch)
+    cur, stops, trip_ids, trip_id_to_delays = run_single.setup
+
+    def run():
+        boards = find_boards(cur, stops, trip_ids, trip_id_to_delays, QUERY_DATE)
+        return sum(len(lst) for lst in boards.values()), None
+    return run
+
+def bench_query_window(feed_path, scratch):
+    """bench_query_boards with a 90 minute window, like print_updates.py --window 90"""
+    run_single = bench_query(feed_path, scratch)
+    cur, stops, trip_ids, trip_id_to_delays = run_single.setup
+
+    def run():
+        boards = find_boards(cur, stops, trip_ids, trip_id_to_delays, QUERY_DATE, window=QUERY_WINDOW)
+        return sum(len(lst) for lst in boards.values()), None
+    return run
+
+BENCHMARKS = OrderedDict([
+    ("read_stop_times_table", bench_read_stop_times),
+    ("compress_stop_times_table", bench_compress_stop_times),
+    ("write_tables", bench_write_tables),
+    ("schedule_compress", bench_schedule_compress),
+    ("query", bench_query),
+    ("query_boards", bench_query_boards),
+    ("query_window", bench_query_window),
+])
+
+def time_benchmark(make_run, feed_path, scratch, repeat, measure_memory):
+    """Returns the result for one benchmark, using the fastest of repeat runs"""
+    run = make_run(feed_path, scratch)
+    best = None
+    rows = 0
+    for i in range(repeat):
+        start = time.perf_counter()
+        rows, seconds = run()
+        if seconds is None:
+            seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    ret = {
+        "rows": rows,
+        "seconds": best,
+        "rows_per_second": rows / best if best > 0 else None,
+    }
+    if measure_memory:
+        # a separate run since tracemalloc slows everything down
+        tracemalloc.start()
+        try:
+            run()
+            ret["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return ret
+
+def run_benchmarks(scales, benchmarks, repeat=3, measure_memory=True, seed=0):
+    results = OrderedDict()
+    for scale in scales:
+        results[scale] = OrderedDict()
+        with tempfile.TemporaryDirectory() as scratch:
+            feed_path = os.path.join(scratch, "feed")
+            generate_feed(feed_path, seed=seed, **SCALES[scale])
+            for name in benchmarks:
+                result = time_benchmark(BENCHMARKS[name], feed_path, scratch, repeat, measure_memory)
+                results[scale][name] = result
+                print_result(scale, name, result)
+    return {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "seed": seed,
+        "results": results,
+    }
+
+def print_result(scale, name, result):
+    line = "%-8s %-26s %10d rows %9.4fs %12.0f rows/s" % (scale, name, result["rows"], result["seconds"],
+                                                        result["rows_per_second"] or 0)
+    if "peak_bytes" in result:
+        line += " %8.1f MB" % (result["peak_bytes"] / (1024 * 1024))
+    print(line)
+
+def compare(results, baseline, tolerance):
+    """Prints each benchmark's time relative to the baseline. Returns a list of (scale, name, ratio)
+    for benchmarks which are slower than the baseline by more than tolerance"""
+    regressions = []
+    print("")
+    print("Compared with baseline (time / baseline time):")
+    for scale, benchmarks in results["results"].items():
+        for name, result in benchmarks.items():
+            old = baseline["results"].get(scale, {}).get(name)
+            if old is None:
+                print("%-8s %-26s not in baseline" % (scale, name))
+                continue
+            if old["rows"] != result["rows"]:
+                print("%-8s %-26s row count changed from %d to %d" % (scale, name, old["rows"], result["rows"]))
+            ratio = result["seconds"] / old["seconds"] if old["seconds"] > 0 else 1.0
+            line = "%-8s %-26s %6.2fx" % (scale, name, ratio)
+            if "peak_bytes" in result and "peak_bytes" in old and old["peak_bytes"] > 0:
+                line += "  memory %6.2fx" % (result["peak_bytes"] / old["peak_bytes"])
+            if ratio > 1 + tolerance:
+                line += "  SLOWER"
+                regressions.append((scale, name, ratio))
+            print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the database build and queries on synthetic feeds')
+    parser.add_argument('--scale', action='append', choices=list(SCALES.keys()),
+                        help='Feed size to run, can be given more than once. Defaults to small and medium')
+    parser.add_argument('--benchmark', action='append', choices=list(BENCHMARKS.keys()),
+                        help='Benchmark to run, can be given more than once. Defaults to all of them')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs to take the fastest of')
+    parser.add_argument('--no-memory', action='store_true', help="Don't measure peak memory with tracemalloc")
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic feeds')
+    parser.add_argument('--save', help='Write the results as JSON to this file, to use as a baseline later')
+    parser.add_argument('--baseline', help='Compare with results saved earlier with --save')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much slower than the baseline a benchmark can be before it fails, '
+                             '0.2 means 20%% slower')
+
+    args = parser.parse_args()
+
+    if args.baseline is not None and not os.path.exists(args.baseline):
+        print("Baseline %s doesn't exist" % args.baseline)
+        exit(-1)
+
+    results = run_benchmarks(args.scale or ["small", "medium"], args.benchmark or list(BENCHMARKS.keys()),
+                             args.repeat, not args.no_memory, args.seed)
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("%d benchmarks are slower than the baseline" % len(regressions))
+            exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+__author__ = 'schneg'
+
+from box import Box
+
+# Blob formats shared by make_database.py (which writes them) and print_updates.py (which reads them)
+
+ARRIVALS_VERSION = 1
+
+# set if every time is a whole minute, deltas are then stored in minutes
+ARRIVALS_FLAG_MINUTES = 1
+# set if any stop has a departure different from its arrival. Otherwise departures aren't stored
+ARRIVALS_FLAG_DEPARTURES = 2
+
+def encode_arrivals(lst):
+    """lst is a list of (arrival_seconds, departure_seconds) relative to the start of the trip.
+
+    The layout is a version byte, a flags byte, a varint count, then for each stop the
+    difference from the previous stop's arrival as a zigzag varint. If ARRIVALS_FLAG_DEPARTURES is set
+    that's followed by departure - arrival for each stop, also as zigzag varints
+    """
+    flags = 0
+    if all(arrival % 60 == 0 and departure % 60 == 0 for arrival, departure in lst):
+        flags |= ARRIVALS_FLAG_MINUTES
+        unit = 60
+    else:
+        unit = 1
+    if any(arrival != departure for arrival, departure in lst):
+        flags |= ARRIVALS_FLAG_DEPARTURES
+
+    deltas = []
+    prev = 0
+    for arrival_seconds, departure_seconds in lst:
+        deltas.append((arrival_seconds - prev) // unit)
+        prev = arrival_seconds
+
+    box = Box()
+    box.add_byte(ARRIVALS_VERSION)
+    box.add_byte(flags)
+    box.add_varint(len(lst))
+    box.add_signed_varints(deltas)
+    if flags & ARRIVALS_FLAG_DEPARTURES:
+        box.add_signed_varints([(departure_seconds - arrival_seconds) // unit
+                                for arrival_seconds, departure_seconds in lst])
+    return box.get_bytes()
+
+def decode_arrivals(blob):
+    """Returns (arrivals, departures), two lists of seconds relative to the start of the trip.
+    This reads straight from the blob without copying it"""
+    box = Box(blob)
+    version = box.read_byte()
+    if version != ARRIVALS_VERSION:
+        raise Exception("Unsupported arrivals blob version %d, rebuild the database" % version)
+    flags = box.read_byte()
+    count = box.read_varint()
+    unit = 60 if flags & ARRIVALS_FLAG_MINUTES else 1
+
+    arrivals = []
+    current = 0
+    for delta in box.read_signed_varints(count):
+        current += delta * unit
+        arrivals.append(current)
+
+    if flags & ARRIVALS_FLAG_DEPARTURES:
+        departures = [arrival + dwell * unit for arrival, dwell in zip(arrivals, box.read_signed_varints(count))]
+    else:
+        departures = arrivals
+    return arrivals, departures
+
+def encode_stop_list(lst, stop_index_map):
+    """lst is a list of (stop_id, sequence). stop_id is stored as its index in the stop_ids table.
+
+    The layout is a short count, a byte with the width of each index (2 or 4),
+    then all the indexes, then all the sequences as shorts
+    """
+    indexes = [stop_index_map[stop_id] for stop_id, sequence in lst]
+    sequences = [sequence for stop_id, sequence in lst]
+
+    box = Box()
+    box.add_short(len(lst))
+    if len(indexes) == 0 or max(indexes) <= 0xffff:
+        box.add_byte(2)
+        box.add_shorts(indexes)
+    else:
+        box.add_byte(4)
+        for index in indexes:
+            box.add_int(index)
+    box.add_shorts(sequences)
+    return box.get_bytes()
+
+def decode_stop_list(blob):
+    """Returns (stop indexes, sequences) as two tuples"""
+    box = Box(blob)
+    count = box.read_short()
+    width = box.read_byte()
+    if width == 2:
+        indexes = box.read_shorts(count)
+    elif width == 4:
+        indexes = box.read_ints(count)
+    else:
+        raise Exception("Unexpected stop index width %d" % width)
+    sequences = box.read_shorts(count)
+    return indexes, sequences
@@ -11,37 +11,87 @@ class Box:
     box.add_int(-4)
 
     print("INSERT INTO table VALUES (%s)" % box.get_blob_string()")
+
+    To read, pass the blob to the constructor and call the read_* methods in the same order:
+
+    box = Box(blob)
+    box.read_int()
     """
     def __init__(self, bytes=None):
         if bytes is None:
-            self.bytes = "" # this is hex
+            self.bytes = bytearray()
         else:
-            self.bytes = bytes
+            # memoryview so reads don't copy the blob
+            self.bytes = memoryview(bytes)
             self.pos = 0
 
     def read_short(self):
-        s = self.bytes[self.pos:self.pos+2]
+        ret = struct.unpack_from('>H', self.bytes, self.pos)[0]
         self.pos += 2
-        return struct.unpack('>H', s)[0]
+        return ret
+
+    def read_shorts(self, count):
+        """Reads count shorts at once, returns a tuple"""
+        ret = struct.unpack_from('>%dH' % count, self.bytes, self.pos)
+        self.pos += 2 * count
+        return ret
 
     def read_int(self):
-        s = self.bytes[self.pos:self.pos+4]
+        ret = struct.unpack_from('>i', self.bytes, self.pos)[0]
         self.pos += 4
-        return struct.unpack('>i', s)[0]
+        return ret
+
+    def read_ints(self, count):
+        """Reads count ints at once, returns a tuple"""
+        ret = struct.unpack_from('>%di' % count, self.bytes, self.pos)
+        self.pos += 4 * count
+        return ret
+
+    def read_varint(self):
+        """Reads an unsigned LEB128 varint"""
+        data = self.bytes
+        pos = self.pos
+        shift = 0
+        ret = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            ret |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return ret
+
+    def read_signed_varints(self, count):
+        """Reads count zigzag encoded varints at once, returns a list"""
+        data = self.bytes
+        pos = self.pos
+        ret = []
+        for i in range(count):
+            shift = 0
+            x = 0
+            while True:
+                b = data[pos]
+                pos += 1
+                x |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            ret.append((x >> 1) ^ -(x & 1))
+        self.pos = pos
+        return ret
 
     def read_byte(self):
-        s = self.bytes[self.pos:self.pos+1]
+        ret = self.bytes[self.pos]
         self.pos += 1
-        return struct.unpack('>B', s)[0]
+        return ret
 
-    def read_string(self):
-        # adapted from http://stackoverflow.com/questions/1393004/java-modified-utf-8-strings-in-python
-        length = struct.unpack('!H', self.bytes[self.pos:self.pos+2])
-        self.pos += 2
-        format = '!' + str(length) + 's'
-        chunk = struct.unpack(format, self.bytes[self.pos:self.pos+length])
-        self.pos += length
-        return chunk
+    def _reserve(self, size):
+        """Grows the buffer by size bytes and returns the offset to write at"""
+        pos = len(self.bytes)
+        self.bytes.extend(b'\0' * size)
+        return pos
 
     def add_string(self, s):
         if type(s) != str:
@@ -51,36 +101,49 @@ class Box:
 
         # adapted from http://stackoverflow.com/questions/1393004/java-modified-utf-8-strings-in-python
         utf8 = s.encode('utf-8')
-        length = len(utf8)
-        self.bytes += self.to_str(binascii.b2a_hex(struct.pack('!H', length)))
-        format = '!' + str(length) + 's'
-        self.bytes += self.to_str(binascii.b2a_hex(struct.pack(format, utf8)))
+        self.add_short(len(utf8))
+        self.bytes.extend(utf8)
 
     def add_short(self, x):
         if x < 0 or x > 0xffff:
             raise Exception("x out of range")
-        self.bytes += self.to_str(binascii.b2a_hex(struct.pack('>H', x)))
+        struct.pack_into('>H', self.bytes, self._reserve(2), x)
+
+    def add_shorts(self, xs):
+        """Writes every value in xs as a short. This doesn't write the length"""
+        if len(xs) == 0:
+            return
+        if min(xs) < 0 or max(xs) > 0xffff:
+            raise Exception("x out of range")
+        struct.pack_into('>%dH' % len(xs), self.bytes, self._reserve(2 * len(xs)), *xs)
+
+    def add_varint(self, x):
+        """Writes a non-negative int as an unsigned LEB128 varint, 7 bits per byte"""
+        if x < 0:
+            raise Exception("x out of range")
+        while x >= 0x80:
+            self.bytes.append((x & 0x7f) | 0x80)
+            x >>= 7
+        self.bytes.append(x)
+
+    def add_signed_varints(self, xs):
+        """Writes each value zigzag encoded so small negative numbers stay small. This doesn't write the length"""
+        for x in xs:
+            self.add_varint((x << 1) if x >= 0 else ((-x << 1) - 1))
 
     def add_byte(self, x):
         if x < 0 or x > 0xff:
             raise Exception("x out of range")
-        self.bytes += self.to_str(binascii.b2a_hex(struct.pack('>B', x)))
+        self.bytes.append(x)
 
     def add_int(self, x):
-        self.bytes += self.to_str(binascii.b2a_hex(struct.pack('>i', x)))
-
-    def add_ints(self, ints):
-        self.add_int(len(ints))
-        for i in ints:
-            self.add_int(i)
+        struct.pack_into('>i', self.bytes, self._reserve(4), x)
 
     def add_float(self, f):
-        self.bytes += self.to_str(binascii.b2a_hex(struct.pack('>f', f)))
-
-    def to_str(self, b):
-        return b.decode("utf-8")
+        struct.pack_into('>f', self.bytes, self._reserve(4), f)
 
     def get_blob_string(self):
-        return "X'" + self.bytes + "'"
-
+        return "X'" + binascii.b2a_hex(self.bytes).decode('ascii') + "'"
 
+    def get_bytes(self):
+        return bytes(self.bytes)
@@ -0,0 +1,137 @@
+__author__ = 'schneg'
+
+import csv
+import io
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+
+from feed_files import (
+    feed_file_size,
+    open_binary,
+    open_text,
+    split_zip_path,
+)
+
+# bytes of CSV in each range handed to a worker. Ranges are small so only a few are in memory at once
+RANGE_SIZE = 4 * 1024 * 1024
+
+def make_index_map(array):
+    ret = {}
+    for i, item in enumerate(array):
+        ret[item] = i
+    return ret
+
+def group_runs(rows, parse_row):
+    """parse_row turns a csv row into (key, value). This yields (key, [value, ...]) for each run
+    of consecutive rows with the same key, so a file sorted by trip_id gives one run per trip"""
+    current_key = None
+    current = None
+    for row in rows:
+        key, value = parse_row(row)
+        if current is None or key != current_key:
+            if current is not None:
+                yield current_key, current
+            current_key = key
+            current = []
+        current.append(value)
+
+    if current is not None:
+        yield current_key, current
+
+def find_ranges(path, range_size=RANGE_SIZE):
+    """Splits the file after the header line into byte ranges of about range_size bytes
+    which start and end on line boundaries. Returns (header, list of (start, end))
+
+    This assumes there are no newlines inside quoted fields, which is true for stop_times.txt in practice.
+    """
+    size = feed_file_size(path)
+    with open_binary(path) as f:
+        header = next(csv.reader([f.readline().decode("utf-8-sig")]))
+        data_start = f.tell()
+
+        boundaries = [data_start]
+        pos = data_start + range_size
+        while pos < size:
+            # start reading one byte early so a range already beginning on a line keeps that line
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            boundaries.append(pos)
+            pos += range_size
+        boundaries.append(size)
+
+    return header, [(boundaries[i], boundaries[i+1]) for i in range(len(boundaries) - 1)]
+
+def read_range(task):
+    """Returns a csv reader over the rows in a task from map_ranges"""
+    path, start, end, header, data = task
+    if data is None:
+        with open_binary(path) as f:
+            f.seek(start)
+            data = f.read(end - start)
+    return csv.reader(io.StringIO(data.decode("utf-8"), newline=''))
+
+def iter_tasks(path, header, ranges):
+    archive, name = split_zip_path(path)
+    if archive is None:
+        # each worker reads its own range
+        for start, end in ranges:
+            yield path, start, end, header, None
+        return
+    # seeking in a zip member means decompressing everything before it, so read it once here
+    with open_binary(path) as f:
+        f.seek(ranges[0][0])
+        for start, end in ranges:
+            yield path, start, end, header, f.read(end - start)
+
+def map_ranges(path, parse, jobs, range_size=RANGE_SIZE):
+    """Splits the file into ranges with find_ranges and yields parse(task) for each range in file order,
+    running parse in a pool of jobs processes. parse must be a module level function (or a partial of one)
+    so it can be sent to the workers. It can read the range's rows with read_range(task), the header is task[3].
+
+    Only a couple of ranges per worker are sent out at once, so memory is bounded by the range size
+    and the size of what parse returns, not the file size. path may be inside a zip file, see feed_files
+    """
+    header, ranges = find_ranges(path, range_size)
+    if len(ranges) == 0:
+        return
+    with Pool(jobs) as pool:
+        pending = deque()
+        for task in iter_tasks(path, header, ranges):
+            pending.append(pool.apply_async(parse, (task,)))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+def parse_range(make_row_parser, task):
+    """Runs in a worker process. Parses one byte range and returns its runs as a list"""
+    parse_row = make_row_parser(make_index_map(task[3]))
+    return list(group_runs(read_range(task), parse_row))
+
+def iter_runs(path, make_row_parser, jobs=1):
+    """Yields (key, [value, ...]) runs for a CSV file in file order, see group_runs.
+
+    make_row_parser is given the header index map and returns a function which turns a row into (key, value).
+    It must be a module level function so it can be sent to worker processes.
+
+    With jobs > 1 the file is split into byte ranges which are parsed in a process pool, see map_ranges.
+    A run which crosses a range boundary comes back as two runs with the same key, callers must treat
+    consecutive runs with the same key as one. The output is otherwise identical to the serial path.
+
+    path may be inside a zip file, see feed_files.
+    """
+    if jobs <= 1:
+        with open_text(path) as f:
+            reader = csv.reader(f)
+            parse_row = make_row_parser(make_index_map(next(reader)))
+            for run in group_runs(reader, parse_row):
+                yield run
+        return
+
+    for runs in map_ranges(path, partial(parse_range, make_row_parser), jobs):
+        for run in runs:
+            yield run
@@ -0,0 +1,98 @@
+__author__ = 'schneg'
+
+import binascii
+import sqlite3
+from itertools import islice
+
+def escaped(s):
+    return s.replace("'", "''")
+
+def sql_literal(value):
+    if value is None:
+        return "NULL"
+    elif isinstance(value, int):
+        return "%d" % value
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return "X'" + binascii.b2a_hex(value).decode("ascii") + "'"
+    else:
+        return "'%s'" % escaped(value)
+
+class SqlDumpWriter:
+    """Writes the database as a text file of SQL statements, one INSERT per row.
+    Create the database with: sqlite3 new.db < output.sql
+    """
+    def __init__(self, path):
+        self.out_file = open(path, "w")
+        self.rows_written = 0
+
+    def begin(self):
+        self.out_file.write("BEGIN TRANSACTION;\n")
+
+    def execute(self, statement):
+        self.out_file.write(statement + ";\n")
+
+    def insert_rows(self, table, rows):
+        for row in rows:
+            self.out_file.write("INSERT INTO %s VALUES (%s);\n" % (table, ", ".join(sql_literal(x) for x in row)))
+            self.rows_written += 1
+
+    def commit(self):
+        self.out_file.write("END TRANSACTION;\n")
+
+    def close(self):
+        self.out_file.close()
+
+class SqliteWriter:
+    """Writes directly into a SQLite database using batched executemany calls.
+
+    Everything happens in one transaction with the journal turned off, so an interrupted
+    build leaves a broken database behind. Delete it and run again.
+    """
+    BULK_LOAD_PRAGMAS = [
+        "PRAGMA journal_mode = OFF",
+        "PRAGMA synchronous = OFF",
+        "PRAGMA locking_mode = EXCLUSIVE",
+        "PRAGMA temp_store = MEMORY",
+        # negative means KiB, so this is 256MB
+        "PRAGMA cache_size = -262144",
+    ]
+
+    def __init__(self, path, batch_size=10000):
+        self.batch_size = batch_size
+        self.rows_written = 0
+        # isolation_level=None so we control the transaction ourselves
+        self.con = sqlite3.connect(path, isolation_level=None)
+        for pragma in self.BULK_LOAD_PRAGMAS:
+            self.con.execute(pragma)
+
+    def begin(self):
+        self.con.execute("BEGIN TRANSACTION")
+
+    def execute(self, statement):
+        self.con.execute(statement)
+
+    def insert_rows(self, table, rows):
+        rows = iter(rows)
+        statement = None
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if len(batch) == 0:
+                break
+            if statement is None:
+                statement = "INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * len(batch[0])))
+            self.con.executemany(statement, batch)
+            self.rows_written += len(batch)
+
+    def commit(self):
+        self.con.execute("COMMIT")
+
+    def close(self):
+        self.con.close()
+
+def open_writer(path, format):
+    if format == "sql":
+        return SqlDumpWriter(path)
+    elif format == "sqlite":
+        return SqliteWriter(path)
+    else:
+        raise Exception("Unknown output format: %s" % format)
@@ -0,0 +1,47 @@
+__author__ = 'schneg'
+
+from array import array
+from bisect import bisect_right
+from operator import itemgetter
+
+class TripDelays:
+    """The stop_time_updates of one trip as two arrays sorted by stop_sequence, built once per feed message.
+
+    The delay at a stop is the delay of the last update at or before its stop_sequence, or 0 before the first one.
+    When two updates have the same stop_sequence the later one in the feed wins
+    """
+    __slots__ = ("sequences", "delays")
+
+    def __init__(self, updates):
+        """updates is a list of (stop_sequence, delay) in feed order"""
+        updates = sorted(updates, key=itemgetter(0))
+        self.sequences = array('i', [sequence for sequence, delay in updates])
+        self.delays = array('i', [delay for sequence, delay in updates])
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def delay_at(self, sequence):
+        """Delay for one stop, by binary search"""
+        i = bisect_right(self.sequences, sequence)
+        return self.delays[i - 1] if i > 0 else 0
+
+    def delays_for(self, sequences):
+        """Delays for every stop of a decoded stop list in one merge pass, sequences should be increasing.
+        Falls back to delay_at for stops which go backwards"""
+        ret = []
+        update_sequences = self.sequences
+        count = len(update_sequences)
+        i = 0
+        current = 0
+        prev_sequence = None
+        for sequence in sequences:
+            if prev_sequence is not None and sequence < prev_sequence:
+                ret.append(self.delay_at(sequence))
+                continue
+            prev_sequence = sequence
+            while i < count and update_sequences[i] <= sequence:
+                current = self.delays[i]
+                i += 1
+            ret.append(current)
+        return ret
@@ -0,0 +1,232 @@
+__author__ = 'schneg'
+
+import asyncio
+import inspect
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import (
+    urljoin,
+    urlsplit,
+)
+
+from realtime import (
+    FeedVersion,
+    is_url,
+    read_file,
+)
+
+# An asyncio client for polling GTFS-realtime feeds, used by print_updates.py. Any number of sources
+# (trip updates from several agencies, vehicle positions, alerts) are polled at once, each on its own interval.
+# A poll which gets back the same snapshot as last time, by HTTP validators, content hash or FeedHeader.timestamp,
+# stops there without decoding anything.
+# Only the standard library is needed, the HTTP client below is just enough for a GET of a feed
+
+DEFAULT_INTERVAL = 30
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_BACKOFF = 300
+MAX_REDIRECTS = 5
+
+async def read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            # trailers, then a blank line
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+async def http_request(url, headers):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise Exception("Unsupported URL %s" % url)
+    secure = parts.scheme == "https"
+    port = parts.port or (443 if secure else 80)
+    reader, writer = await asyncio.open_connection(parts.hostname, port,
+                                                   ssl=ssl.create_default_context() if secure else None)
+    try:
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        lines = ["GET %s HTTP/1.1" % path, "Host: %s" % parts.netloc, "Connection: close",
+                 "Accept-Encoding: identity"]
+        lines.extend("%s: %s" % (name, value) for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+        status_line = (await reader.readline()).decode("latin-1").split(None, 2)
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+            raise Exception("Bad response from %s" % url)
+        status = int(status_line[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if status in (204, 304) or status < 200:
+            body = b""
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await read_chunked(reader)
+        elif "content-length" in response_headers:
+            body = await reader.readexactly(int(response_headers["content-length"]))
+        else:
+            body = await reader.read()
+    finally:
+        writer.close()
+    return status, response_headers, body
+
+async def http_get(url, headers=None, timeout=DEFAULT_TIMEOUT):
+    """Returns (status, headers with lowercase names, body) for a GET of url, following redirects.
+    Raises asyncio.TimeoutError if the whole thing takes longer than timeout seconds"""
+    async def get(url):
+        for i in range(MAX_REDIRECTS + 1):
+            status, response_headers, body = await http_request(url, headers or {})
+            if status not in (301, 302, 303, 307, 308) or "location" not in response_headers:
+                return status, response_headers, body
+            url = urljoin(url, response_headers["location"])
+        raise Exception("Too many redirects for %s" % url)
+    return await asyncio.wait_for(get(url), timeout)
+
+class FeedSource:
+    """One feed to poll. url is http(s), or the path of a file which stands in for the real feed when testing"""
+    def __init__(self, url, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.polls = 0
+        # polls which were decoded and passed on, and ones which stopped because the feed hadn't changed
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        # errors since the last successful poll, for backing off
+        self.failures = 0
+        self.last_poll = None
+        self.last_error = None
+        # ETag and Last-Modified of the last feed processed, sent back as If-None-Match and If-Modified-Since
+        self.validators = {}
+        self.version = FeedVersion()
+
+    def __repr__(self):
+        return "FeedSource(%r)" % self.url
+
+    def next_delay(self, max_backoff):
+        """Seconds until the next poll, doubling after each failure in a row up to max_backoff"""
+        if self.failures == 0:
+            return self.interval
+        return min(self.interval * 2 ** self.failures, max(max_backoff, self.interval))
+
+    def stats(self):
+        return "%d processed, %d skipped as unchanged, %d errors" % (self.processed, self.skipped, self.errors)
+
+    async def fetch(self, loop):
+        """Returns (data, validators) where data is None if the server says the feed hasn't changed.
+        Pass validators to accept once the feed has been processed"""
+        if is_url(self.url):
+            request_headers = {}
+            if "etag" in self.validators:
+                request_headers["If-None-Match"] = self.validators["etag"]
+            if "last-modified" in self.validators:
+                request_headers["If-Modified-Since"] = self.validators["last-modified"]
+            status, headers, body = await http_get(self.url, request_headers, self.timeout)
+            if status == 304:
+                return None, None
+            if status != 200:
+                raise Exception("HTTP %d from %s" % (status, self.url))
+            return body, dict((name, headers[name]) for name in ("etag", "last-modified") if name in headers)
+        data = await asyncio.wait_for(loop.run_in_executor(None, read_file, self.url), self.timeout)
+        return data, {}
+
+    def accept(self, validators, version):
+        self.validators = validators
+        self.version.accept(version)
+
+def make_sources(feeds, interval, timeout):
+    """A FeedSource for each --feed URL [SECONDS] in feeds, polled every SECONDS or interval seconds"""
+    return [FeedSource(values[0], float(values[1]) if len(values) == 2 else interval, timeout) for values in feeds]
+
+def check_feeds(parser, feeds):
+    """Exits with an argparse error if one of feeds isn't URL [SECONDS]"""
+    for values in feeds or []:
+        if len(values) > 2 or (len(values) == 2 and not values[1].replace(".", "", 1).isdigit()):
+            parser.error("--feed takes a URL and optionally how often to poll it in seconds")
+
+async def call(callback, *args):
+    """Calls callback, and waits for the result if it's a coroutine"""
+    result = callback(*args)
+    if inspect.isawaitable(result):
+        await result
+
+class FeedPoller:
+    """Polls every source at once, each on its own interval.
+
+    Each feed is fetched on the event loop, then decode(data) runs in executor so a slow parse doesn't hold
+    up the other sources, then on_update(source, decoded) is called back on the loop. If the feed is the same
+    snapshot as the last one processed neither is called. on_polled(source), if given, is called after every poll
+    which worked either way. on_update and on_polled can be coroutine functions, the poll waits for them.
+    Errors from any of these are passed to on_error(source, e) and the source is tried again after a backoff
+    """
+    def __init__(self, sources, decode, on_update, on_error=None, executor=None, max_backoff=DEFAULT_MAX_BACKOFF,
+                 on_polled=None):
+        self.sources = sources
+        self.decode = decode
+        self.on_update = on_update
+        self.on_error = on_error
+        self.on_polled = on_polled
+        # one worker, decode is usually CPU bound so more threads wouldn't help
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+        self.max_backoff = max_backoff
+
+    async def poll(self, source):
+        """Fetches and decodes source once and calls on_update, unless the feed hasn't changed.
+        Returns True if it worked"""
+        loop = asyncio.get_running_loop()
+        try:
+            data, validators = await source.fetch(loop)
+            if data is not None:
+                unchanged, version = source.version.check(data)
+            if data is None or unchanged:
+                if data is not None:
+                    # the same feed with new validators, they'll get a 304 next time
+                    source.validators = validators
+                source.skipped += 1
+            else:
+                decoded = await loop.run_in_executor(self.executor, self.decode, data)
+                await call(self.on_update, source, decoded)
+                source.accept(validators, version)
+                source.processed += 1
+            source.polls += 1
+            source.failures = 0
+            source.last_poll = time.time()
+            if self.on_polled is not None:
+                await call(self.on_polled, source)
+        except Exception as e:
+            source.errors += 1
+            source.failures += 1
+            source.last_error = str(e) or e.__class__.__name__
+            if self.on_error is None:
+                raise
+            self.on_error(source, e)
+            return False
+        return True
+
+    async def poll_all(self):
+        """Polls every source once at the same time. Returns how many worked"""
+        results = await asyncio.gather(*[self.poll(source) for source in self.sources])
+        return sum(1 for result in results if result)
+
+    async def run_source(self, source):
+        while True:
+            await self.poll(source)
+            await asyncio.sleep(source.next_delay(self.max_backoff))
+
+    async def run(self):
+        """Polls every source forever"""
+        await asyncio.gather(*[self.run_source(source) for source in self.sources])
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,66 @@
+__author__ = 'schneg'
+
+import io
+import os
+import zipfile
+
+# A GTFS feed can be a directory or a .zip file. Files in it are referred to by joining the feed path
+# and the file name as usual, like os.path.join("gtfs.zip", "stop_times.txt"), and the functions here
+# read them from the archive without extracting it. Each call opens the archive again, so worker
+# processes can each read the same feed independently.
+
+def is_feed(path):
+    return os.path.isdir(path) or (os.path.isfile(path) and zipfile.is_zipfile(path))
+
+def split_zip_path(path):
+    """Returns (archive path, file name) if path is a file inside a zip, otherwise (None, path)"""
+    archive, name = os.path.split(path)
+    if os.path.isfile(archive) and zipfile.is_zipfile(archive):
+        return archive, name
+    return None, path
+
+def find_member(zip_file, name):
+    """Some feeds have their files in a subdirectory inside the zip"""
+    names = zip_file.namelist()
+    if name in names:
+        return zip_file.getinfo(name)
+    for member in names:
+        if os.path.basename(member) == name:
+            return zip_file.getinfo(member)
+    return None
+
+def feed_file_exists(path):
+    archive, name = split_zip_path(path)
+    if archive is None:
+        return os.path.exists(path)
+    with zipfile.ZipFile(archive) as zip_file:
+        return find_member(zip_file, name) is not None
+
+def feed_file_size(path):
+    """Uncompressed size in bytes"""
+    archive, name = split_zip_path(path)
+    if archive is None:
+        return os.path.getsize(path)
+    with zipfile.ZipFile(archive) as zip_file:
+        return find_member(zip_file, name).file_size
+
+def open_binary(path):
+    """Opens a feed file for reading bytes. Files inside a zip are decompressed as they're read.
+    They can still seek, but seeking means decompressing everything up to that point"""
+    archive, name = split_zip_path(path)
+    if archive is None:
+        return open(path, "rb")
+    zip_file = zipfile.ZipFile(archive)
+    member = find_member(zip_file, name)
+    if member is None:
+        zip_file.close()
+        raise Exception("%s is not in %s" % (name, archive))
+    # the archive stays open until the member is closed
+    return zip_file.open(member)
+
+def open_text(path):
+    """Opens a feed file for reading with the csv module"""
+    archive, name = split_zip_path(path)
+    if archive is None:
+        return open(path, encoding="utf-8-sig", newline='')
+    return io.TextIOWrapper(open_binary(path), encoding="utf-8-sig", newline='')
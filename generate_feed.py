@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+__author__ = 'schneg'
+
+import argparse
+import csv
+import io
+import os
+import random
+import zipfile
+
+# Writes made up GTFS feeds of any size for the benchmarks. The same arguments and seed always give the same feed.
+
+SERVICES = [
+    ("WKDY", "1", "1", "1", "1", "1", "0", "0"),
+    ("SAT", "0", "0", "0", "0", "0", "1", "0"),
+    ("SUN", "0", "0", "0", "0", "0", "0", "1"),
+]
+START_DATE = "20260101"
+END_DATE = "20261231"
+HOLIDAYS = ["20260525", "20260704", "20261126", "20261225"]
+
+FIRST_DEPARTURE = 5 * 60 * 60
+# the last trips go past midnight, like real feeds
+LAST_DEPARTURE = 25 * 60 * 60
+
+def format_gtfs_time(seconds):
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def route_stops(rnd, route_index, stops_per_trip, stop_count):
+    """Each route goes through its own stops plus a few shared with other routes, like transfer points"""
+    first = (route_index * stops_per_trip // 2) % stop_count
+    stops = [(first + i) % stop_count for i in range(stops_per_trip)]
+    for i in range(0, stops_per_trip, 5):
+        stops[i] = rnd.randrange(stop_count)
+    # a stop can only appear once per trip
+    seen = set()
+    ret = []
+    for stop in stops:
+        while stop in seen:
+            stop = (stop + 1) % stop_count
+        seen.add(stop)
+        ret.append(stop)
+    return ret
+
+def generate_tables(routes=10, trips_per_route=100, stops_per_trip=20, regularity=0.8, seconds_share=0.1, seed=0):
+    """Returns file name -> list of rows, header first.
+
+    regularity is the share of trips which leave exactly on their route's headway, the others are moved
+    by a few minutes. Regular trips with the same stop times become headway runs in make_database.
+    seconds_share is the share of trips whose times aren't whole minutes and which wait at some stops.
+    """
+    rnd = random.Random(seed)
+    stop_count = max(stops_per_trip, routes * stops_per_trip // 2)
+
+    tables = {
+        "agency.txt": [("agency_id", "agency_name", "agency_url", "agency_timezone"),
+                       ("SYN", "Synthetic Transit", "http://example.com", "America/New_York")],
+        "routes.txt": [("route_id", "agency_id", "route_short_name", "route_type")],
+        "stops.txt": [("stop_id", "stop_name", "stop_lat", "stop_lon")],
+        "trips.txt": [("route_id", "service_id", "trip_id", "trip_headsign", "direction_id")],
+        "stop_times.txt": [("trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence")],
+        "calendar.txt": [("service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday",
+                          "sunday", "start_date", "end_date")],
+        "calendar_dates.txt": [("service_id", "date", "exception_type")],
+    }
+    for service in SERVICES:
+        tables["calendar.txt"].append(service + (START_DATE, END_DATE))
+    for date in HOLIDAYS:
+        tables["calendar_dates.txt"].append(("WKDY", date, "2"))
+        tables["calendar_dates.txt"].append(("SUN", date, "1"))
+
+    for i in range(stop_count):
+        tables["stops.txt"].append(("stop%d" % i, "Stop %d" % i,
+                                    "%.6f" % (42.3 + rnd.random() / 10), "%.6f" % (-71.1 + rnd.random() / 10)))
+
+    for route_index in range(routes):
+        route_id = "route%d" % route_index
+        tables["routes.txt"].append((route_id, "SYN", str(route_index + 1), "3"))
+        stops = route_stops(rnd, route_index, stops_per_trip, stop_count)
+        # minutes between stops, the same for every trip on the route
+        travel = [rnd.randint(1, 4) for i in range(stops_per_trip - 1)]
+
+        # trips are spread over the services and both directions
+        groups = [(service[0], direction) for service in SERVICES for direction in (0, 1)]
+        for group_index, (service_id, direction) in enumerate(groups):
+            count = trips_per_route // len(groups) + (1 if group_index < trips_per_route % len(groups) else 0)
+            if count == 0:
+                continue
+            headway = max(60, ((LAST_DEPARTURE - FIRST_DEPARTURE) // count) // 60 * 60)
+            trip_stops = stops if direction == 0 else stops[::-1]
+            trip_travel = travel if direction == 0 else travel[::-1]
+            headsign = "To Stop %s" % trip_stops[-1]
+            for i in range(count):
+                trip_id = "%s_%s_%d_%d" % (route_id, service_id, direction, i)
+                tables["trips.txt"].append((route_id, service_id, trip_id, headsign, str(direction)))
+
+                start = FIRST_DEPARTURE + i * headway
+                if rnd.random() >= regularity:
+                    start += rnd.choice([-3, -2, -1, 1, 2, 3]) * 60
+                with_seconds = rnd.random() < seconds_share
+                if with_seconds:
+                    start += rnd.randint(1, 59)
+
+                arrival = start
+                for sequence, stop in enumerate(trip_stops):
+                    if sequence > 0:
+                        arrival += trip_travel[sequence - 1] * 60
+                        if with_seconds:
+                            arrival += rnd.randint(-20, 20)
+                    departure = arrival
+                    if with_seconds and rnd.random() < 0.2:
+                        departure += rnd.randint(10, 40)
+                    tables["stop_times.txt"].append((trip_id, format_gtfs_time(arrival), format_gtfs_time(departure),
+                                                     "stop%d" % stop, str(sequence + 1)))
+                    arrival = departure
+    return tables
+
+def write_tables(path, tables):
+    """path is a directory to create or a .zip file"""
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for name, rows in sorted(tables.items()):
+                out = io.StringIO(newline='')
+                csv.writer(out, lineterminator="\n").writerows(rows)
+                zip_file.writestr(name, out.getvalue())
+    else:
+        os.makedirs(path)
+        for name, rows in sorted(tables.items()):
+            with open(os.path.join(path, name), "w", newline='') as f:
+                csv.writer(f, lineterminator="\n").writerows(rows)
+
+def generate_feed(path, **kwargs):
+    """Writes a feed to path, see generate_tables for the arguments. Returns the number of stop_times rows"""
+    tables = generate_tables(**kwargs)
+    write_tables(path, tables)
+    return len(tables["stop_times.txt"]) - 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes a synthetic GTFS feed for benchmarks')
+    parser.add_argument('path', help='Directory to create, or a .zip file')
+    parser.add_argument('--routes', type=int, default=10, help='Number of routes')
+    parser.add_argument('--trips-per-route', type=int, default=100, help='Number of trips on each route')
+    parser.add_argument('--stops-per-trip', type=int, default=20, help='Number of stops on each trip')
+    parser.add_argument('--regularity', type=float, default=0.8,
+                        help='Share of trips which leave exactly on the headway, between 0 and 1')
+    parser.add_argument('--seconds-share', type=float, default=0.1,
+                        help='Share of trips with times which are not whole minutes, between 0 and 1')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        print("%s already exists, delete it and try again" % args.path)
+        exit(-1)
+
+    rows = generate_feed(args.path, routes=args.routes, trips_per_route=args.trips_per_route,
+                         stops_per_trip=args.stops_per_trip, regularity=args.regularity,
+                         seconds_share=args.seconds_share, seed=args.seed)
+    print("Wrote %d stop times to %s" % (rows, args.path))
+
+if __name__ == "__main__":
+    main()
@@ -2,72 +2,233 @@
 
 import argparse
 import os
-import csv
+import sqlite3
 from collections import defaultdict
 
-from box import Box
+from blobs import (
+    decode_arrivals,
+    encode_arrivals,
+    encode_stop_list,
+    )
+from chunked_reader import (
+    group_runs,
+    iter_runs,
+    make_index_map,
+    map_ranges,
+    read_range,
+    )
+from db_writer import open_writer
+from feed_files import (
+    feed_file_exists,
+    is_feed,
+    )
+from parse_cache import (
+    StopTimesSnapshot,
+    add_cache_arguments,
+    cache_from_args,
+    file_hash,
+    read_csv_table,
+    )
+from profiling import (
+    BuildProfile,
+    add_profile_arguments,
+    finish_profile,
+    profile_from_args,
+    )
+from services import (
+    ServiceCalendar,
+    format_date,
+    )
 
 from util import (
     parse_time,
     )
 
-def escaped(s):
-    return s.replace("'", "''")
-
+def read_trips(csv_path, cache=None):
+    """yields (trip_id, route_id, service_id) for each row of trips.txt"""
+    seen = set()
+    header, rows = read_csv_table(csv_path, cache)
+
+    header = make_index_map(header)
+    for row in rows:
+        trip_id = row[header["trip_id"]]
+        if "'" in trip_id:
+            # this complicates things on the Java side so
+            # if this happens we need to be aware of it
+            raise Exception("Trip id has a apostrophe")
+
+        route_id = row[header["route_id"]]
+        service_id = row[header["service_id"]]
+        if trip_id in seen:
+            raise Exception("Duplicate trip: %s" % trip_id)
+        seen.add(trip_id)
+        yield trip_id, route_id, service_id
+
+def add_string_ids(index_map, strings):
+    """Gives each string which isn't in index_map yet the next index.
+    Returns the (index, string) rows for the strings which were added"""
+    new_rows = []
+    for s in strings:
+        if s not in index_map:
+            index = len(index_map)
+            index_map[s] = index
+            new_rows.append((index, s))
+    return new_rows
+
+def write_string_ids_table(writer, table, column, index_map):
+    """stop_ids and route_ids map the GTFS string ids to the integers used in the rest of the database"""
+    # TEXT, not STRING, so SQLite doesn't turn ids like '0070' into numbers
+    writer.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, %s TEXT)" % (table, column))
+    writer.insert_rows(table, ((index, s) for s, index in index_map.items()))
+
+def pattern_sort_key(pattern):
+    """Sort key for a trip's (arrival_id, stop_list_id, offset), or None for a trip without stop times"""
+    if pattern is None:
+        return (1,)
+    else:
+        return (0,) + pattern
+
+def services_rows(calendar, service_index_map):
+    """yields (index, service_id, start date, bitset blob) for each service, see services.ServiceCalendar"""
+    if calendar.start_date is None:
+        return
+    start_date = format_date(calendar.start_date)
+    for service_id, index in service_index_map.items():
+        yield index, service_id, start_date, calendar.to_bytes(service_id)
+
+def write_services_table(writer, calendar, service_index_map):
+    """services has the days each service runs on as a bitset, starting from start_date"""
+    writer.execute("CREATE TABLE IF NOT EXISTS services (id INTEGER PRIMARY KEY, service_id TEXT,"
+                   " start_date TEXT, days BLOB)")
+    writer.insert_rows("services", services_rows(calendar, service_index_map))
+
+def write_trip_ids_table(writer, csv_path, route_index_map, service_index_map, stop_times, cache=None):
+    """route_index_map and service_index_map are filled in with an index for each route_id and service_id
+    as trips are read.
+
+    Trips are numbered so that trips with the same arrivals and stop list are next to each other
+    in order of their offset, which lets build_runs collapse them. Trips without stop times come last
+    """
+    ret = {}
+    # TEXT for the same reason as write_string_ids_table
+    writer.execute("CREATE TABLE IF NOT EXISTS trip_ids (id INTEGER PRIMARY KEY, trip_id TEXT, route_id INTEGER,"
+                   " service_id INTEGER)")
 
+    trips = list(read_trips(csv_path, cache))
+    trips.sort(key=lambda tup: pattern_sort_key(stop_times.get(tup[0])))
 
+    def rows():
+        for count, (trip_id, route_id, service_id) in enumerate(trips):
+            ret[trip_id] = count
+            add_string_ids(route_index_map, [route_id])
+            add_string_ids(service_index_map, [service_id])
+            yield count, trip_id, route_index_map[route_id], service_index_map[service_id]
 
-def make_index_map(array):
-    ret = {}
-    for i, item in enumerate(array):
-        ret[item] = i
+    writer.insert_rows("trip_ids", rows())
+    # print_updates.py looks trips up by their GTFS trip_id
+    writer.execute("CREATE INDEX IF NOT EXISTS trip_ids_trip_id ON trip_ids (trip_id)")
     return ret
 
-def write_trip_ids_table(out_file, csv_path):
-    ret = {}
-    out_file.write("CREATE TABLE IF NOT EXISTS trip_ids (id INTEGER PRIMARY KEY, trip_id STRING, route_id STRING);\n")
-    count = 0
-    with open(csv_path) as csv_file:
-        reader = csv.reader(csv_file)
-
-        header = make_index_map(next(reader))
-        for row in reader:
-            trip_id = row[header["trip_id"]]
-            if "'" in trip_id:
-                # this complicates things on the Java side so
-                # if this happens we need to be aware of it
-                raise Exception("Trip id has a apostrophe")
-
-            route_id = row[header["route_id"]]
-            out_file.write("INSERT INTO trip_ids VALUES (%d, '%s', '%s');\n" % (count, trip_id, escaped(route_id)))
-            if trip_id in ret:
-                raise Exception("Duplicate trip: %s" % trip_id)
-            ret[trip_id] = count
-            count += 1
-    return ret
+class StopTimesNotGrouped(Exception):
+    """Raised when stop_times.txt isn't sorted so that each trip's rows are together"""
+    pass
+
+def make_stop_times_row_parser(header):
+    """returns a function turning a stop_times.txt row into (trip_id, (stop_id, sequence, arrival, departure))"""
+    trip_id_index = header["trip_id"]
+    stop_id_index = header["stop_id"]
+    arrival_index = header["arrival_time"]
+    departure_index = header["departure_time"]
+    sequence_index = header["stop_sequence"]
+
+    def parse_row(row):
+        return row[trip_id_index], (row[stop_id_index], int(row[sequence_index]),
+                                    parse_time(row[arrival_index]), parse_time(row[departure_index]))
+    return parse_row
 
-def read_stop_times_table(csv_path):
-    # returns trip_id -> [(stop_id, arrival, departure), etc...]
+def read_stop_times_runs(csv_path, jobs=1, cache=None):
+    """Yields (trip_id, [(stop_id, sequence, arrival, departure), ...]) runs, see chunked_reader.iter_runs.
+
+    With a cache, see parse_cache, the runs come from a snapshot if stop_times.txt was parsed before.
+    Otherwise the whole file is parsed into a snapshot first, which needs memory for every row
+    """
+    if cache is None:
+        return iter_runs(csv_path, make_stop_times_row_parser, jobs)
+    snapshot = cache.get("stop_times", csv_path,
+                         lambda: StopTimesSnapshot.from_runs(iter_runs(csv_path, make_stop_times_row_parser, jobs)))
+    return snapshot.runs()
+
+def read_stop_times_table(csv_path, jobs=1, cache=None):
+    # returns trip_id -> [(stop_id, sequence, arrival, departure), etc...]
     ret = defaultdict(list)
 
-    with open(csv_path) as csv_file:
-        reader = csv.reader(csv_file)
-
-        header = make_index_map(next(reader))
-        for row in reader:
-            trip_id = row[header["trip_id"]]
-            stop_id = row[header["stop_id"]]
-            arrival_seconds = parse_time(row[header["arrival_time"]])
-            departure_seconds = parse_time(row[header["departure_time"]])
-            sequence = int(row[header["stop_sequence"]])
-
-            m = ret[trip_id]
-            if stop_id in m:
-                raise Exception("Stop id %s specified twice for a given trip %s" % (stop_id, trip_id))
-            tup = stop_id, sequence, arrival_seconds, departure_seconds
-            m.append(tup)
+    for trip_id, stop_lst in read_stop_times_runs(csv_path, jobs, cache):
+        ret[trip_id].extend(stop_lst)
     return ret
 
+def iter_stop_times_by_trip(csv_path, jobs=1, cache=None):
+    """Like read_stop_times_table but yields (trip_id, list of tuples) one trip at a time
+    so only one trip is in memory at once. This only works if the rows for each trip are together
+    in the file, otherwise StopTimesNotGrouped is raised when a trip shows up a second time
+    """
+    seen = set()
+    current_trip_id = None
+    current = []
+    for trip_id, stop_lst in read_stop_times_runs(csv_path, jobs, cache):
+        if trip_id == current_trip_id:
+            # a trip split across two byte ranges
+            current.extend(stop_lst)
+            continue
+
+        if current_trip_id is not None:
+            yield current_trip_id, current
+        if trip_id in seen:
+            raise StopTimesNotGrouped("Rows for trip %s are not together" % trip_id)
+        seen.add(trip_id)
+        current_trip_id = trip_id
+        current = stop_lst
+
+    if current_trip_id is not None:
+        yield current_trip_id, current
+
+class StopTimesCompressor:
+    """Compresses one trip at a time. See compress_stop_times_table"""
+    def __init__(self):
+        self.compressed = {}
+        self.arrivals_map = {}
+        self.arrivals_reverse_map = {}
+        self.stops_map = {}
+        self.stops_reverse_map = {}
+
+    def add_trip(self, trip_id, stop_lst):
+        min_seconds = 48 * 60 * 60
+        for tup in stop_lst:
+            stop_id, sequence, arrival_seconds, depart_seconds = tup
+            min_seconds = min(min_seconds, arrival_seconds, depart_seconds)
+        new_arrivals_lst = tuple([(tup[2] - min_seconds, tup[3] - min_seconds) for tup in stop_lst])
+        new_stop_lst = tuple([(tup[0], tup[1]) for tup in stop_lst])
+        self.compressed[trip_id] = (self.arrivals_id(new_arrivals_lst), self.stop_list_id(new_stop_lst), min_seconds)
+
+    def arrivals_id(self, new_arrivals_lst):
+        """Returns the id of a pattern of times, adding it if it's new"""
+        if new_arrivals_lst in self.arrivals_reverse_map:
+            return self.arrivals_reverse_map[new_arrivals_lst]
+        arrivals_id = len(self.arrivals_map)
+        self.arrivals_map[arrivals_id] = new_arrivals_lst
+        self.arrivals_reverse_map[new_arrivals_lst] = arrivals_id
+        return arrivals_id
+
+    def stop_list_id(self, new_stop_lst):
+        """Returns the id of a list of stops, adding it if it's new"""
+        if new_stop_lst in self.stops_reverse_map:
+            return self.stops_reverse_map[new_stop_lst]
+        stop_list_id = len(self.stops_map)
+        self.stops_map[stop_list_id] = new_stop_lst
+        self.stops_reverse_map[new_stop_lst] = stop_list_id
+        return stop_list_id
+
+    def result(self):
+        return self.compressed, self.arrivals_map, self.stops_map
 
 def compress_stop_times_table(stop_times):
     """this iterates through stop_times,
@@ -80,115 +241,467 @@ def compress_stop_times_table(stop_times):
     ret is trip_id -> arrivals_id, stop_list_id, offset
     """
 
-    ret = {}
-    arrivals_map = {}
-    arrivals_reverse_map = {}
-    stops_map = {}
-    stops_reverse_map = {}
+    compressor = StopTimesCompressor()
+    for trip_id, stop_lst in stop_times.items():
+        compressor.add_trip(trip_id, stop_lst)
+    return compressor.result()
 
+def compress_range(task):
+    """Runs in a worker process, see chunked_reader.map_ranges. Compresses the trips in one byte range
+    of stop_times.txt so only their unique patterns are sent back.
 
-    for trip_id, stop_lst in stop_times.items():
-        min_seconds = 48 * 60 * 60
-        for tup in stop_lst:
-            stop_id, sequence, arrival_seconds, depart_seconds = tup
-            min_seconds = min(min_seconds, arrival_seconds, depart_seconds)
-        new_arrivals_lst = tuple([(tup[2] - min_seconds, tup[3] - min_seconds) for tup in stop_lst])
-        new_stop_lst = tuple([(tup[0], tup[1]) for tup in stop_lst])
-        if new_arrivals_lst in arrivals_reverse_map:
-            arrivals_id = arrivals_reverse_map[new_arrivals_lst]
+    The first and last runs may continue in the neighbouring ranges so they are returned as rows.
+    Returns (first run, [(trip_id, arrivals_id, stop_list_id, offset), ...] for the trips in between in file order,
+    arrivals_map, stops_map, last run or None if the range only has one run)
+    """
+    runs = group_runs(read_range(task), make_stop_times_row_parser(make_index_map(task[3])))
+    first = next(runs)
+    compressor = StopTimesCompressor()
+    trips = []
+    last = None
+    for run in runs:
+        if last is not None:
+            trip_id, stop_lst = last
+            compressor.add_trip(trip_id, stop_lst)
+            trips.append((trip_id,) + compressor.compressed[trip_id])
+        last = run
+    return first, trips, compressor.arrivals_map, compressor.stops_map, last
+
+def compress_stop_times_ranges(csv_path, jobs):
+    """Like compress_stop_times_file but the file is compressed in worker processes, one byte range at a time.
+    Patterns from each range are merged in file order so the result is the same as compressing serially"""
+    compressor = StopTimesCompressor()
+    seen = set()
+
+    def add_trip(trip_id, stop_lst):
+        if trip_id in seen:
+            raise StopTimesNotGrouped("Rows for trip %s are not together" % trip_id)
+        seen.add(trip_id)
+        compressor.add_trip(trip_id, stop_lst)
+
+    # a run which may continue in the next range
+    pending = None
+    for first, trips, arrivals_map, stops_map, last in map_ranges(csv_path, compress_range, jobs):
+        if pending is not None and pending[0] == first[0]:
+            pending[1].extend(first[1])
         else:
-            arrivals_id = len(arrivals_map)
-            arrivals_map[arrivals_id] = new_arrivals_lst
-            arrivals_reverse_map[new_arrivals_lst] = arrivals_id
+            if pending is not None:
+                add_trip(*pending)
+            pending = first
+        if last is None:
+            continue
+
+        add_trip(*pending)
+        # ids in this range -> ids in compressor, looked up as trips use them so ids are given out in file order
+        arrival_ids = {}
+        stop_list_ids = {}
+        for trip_id, arrivals_id, stop_list_id, offset in trips:
+            if trip_id in seen:
+                raise StopTimesNotGrouped("Rows for trip %s are not together" % trip_id)
+            seen.add(trip_id)
+            if arrivals_id not in arrival_ids:
+                arrival_ids[arrivals_id] = compressor.arrivals_id(arrivals_map[arrivals_id])
+            if stop_list_id not in stop_list_ids:
+                stop_list_ids[stop_list_id] = compressor.stop_list_id(stops_map[stop_list_id])
+            compressor.compressed[trip_id] = arrival_ids[arrivals_id], stop_list_ids[stop_list_id], offset
+        pending = last
+
+    if pending is not None:
+        add_trip(*pending)
+    return compressor.result()
+
+def compress_stop_times_file(csv_path, jobs=1, cache=None):
+    """Reads and compresses stop_times.txt, returning the same three maps as compress_stop_times_table.
+
+    Trips are compressed as they are read so memory depends on the number of unique patterns,
+    not the number of rows. If the file isn't grouped by trip_id this falls back to reading
+    the whole file first.
+
+    jobs is the number of processes used to parse and compress the file, see compress_stop_times_ranges.
+    cache is a parse_cache.ParseCache or None
+    """
+    try:
+        if jobs > 1 and cache is None:
+            return compress_stop_times_ranges(csv_path, jobs)
+        compressor = StopTimesCompressor()
+        for trip_id, stop_lst in iter_stop_times_by_trip(csv_path, jobs, cache):
+            compressor.add_trip(trip_id, stop_lst)
+    except StopTimesNotGrouped as e:
+        print("%s, reading all of stop_times.txt into memory instead" % e)
+        return compress_stop_times_table(read_stop_times_table(csv_path, jobs, cache))
+    return compressor.result()
+
+def build_runs(trip_patterns):
+    """trip_patterns is trip_ids.id -> (arrival_id, stop_list_id, offset).
+
+    Like the (start, inc, count) pieces in schedules.StopSchedule.compress, trips with consecutive ids,
+    the same arrivals and stop list and offsets which go up by the same headway are collapsed into one run.
+
+    Returns first trip id -> (arrival_id, stop_list_id, first_offset, headway, count).
+    Trip first_id + i of a run starts at first_offset + i * headway
+    """
+    runs = {}
+    first_id = None
+    for db_id in sorted(trip_patterns):
+        arrival_id, stop_list_id, offset = trip_patterns[db_id]
+        if first_id is not None:
+            run_arrival_id, run_stop_list_id, first_offset, headway, count = runs[first_id]
+            if db_id == first_id + count and arrival_id == run_arrival_id and stop_list_id == run_stop_list_id:
+                if count == 1:
+                    headway = offset - first_offset
+                if offset == first_offset + headway * count:
+                    runs[first_id] = arrival_id, stop_list_id, first_offset, headway, count + 1
+                    continue
+        first_id = db_id
+        runs[db_id] = arrival_id, stop_list_id, offset, 0, 1
+    return runs
+
+def expand_runs(runs):
+    """The reverse of build_runs"""
+    ret = {}
+    for first_id, (arrival_id, stop_list_id, first_offset, headway, count) in runs.items():
+        for i in range(count):
+            ret[first_id + i] = arrival_id, stop_list_id, first_offset + i * headway
+    return ret
 
-        if new_stop_lst in stops_reverse_map:
-            stop_list_id = stops_reverse_map[new_stop_lst]
-        else:
-            stop_list_id = len(stops_map)
-            stops_map[stop_list_id] = new_stop_lst
-            stops_reverse_map[new_stop_lst] = stop_list_id
+def write_stop_times_table(writer, runs):
+    """Each row is a run from build_runs. To find a trip's row, look for the row with the largest
+    trip_id <= trip_ids.id and check that the trip is within count of it"""
+    writer.execute("CREATE TABLE IF NOT EXISTS stop_times (trip_id INTEGER PRIMARY KEY, arrival_id INTEGER,"
+                   " stop_list_id INTEGER, offset INTEGER, headway INTEGER, count INTEGER)")
+    writer.insert_rows("stop_times", ((first_id,) + run for first_id, run in sorted(runs.items())))
+    writer.execute("CREATE INDEX IF NOT EXISTS stop_times_stop_list_id ON stop_times (stop_list_id)")
 
-        ret[trip_id] = (arrivals_id, stop_list_id, min_seconds)
+def arrivals_rows(arrivals_map):
+    for arrival_id, lst in arrivals_map.items():
+        yield arrival_id, encode_arrivals(lst)
 
-    return ret, arrivals_map, stops_map
+def arrivals_duration(arrivals):
+    """The latest arrival in a pattern, in seconds from the start of the trip"""
+    return max(arrivals) if len(arrivals) > 0 else 0
 
-def write_stop_times_table(out_file, stop_times, trip_id_map):
-    out_file.write("CREATE TABLE IF NOT EXISTS stop_times (trip_id INTEGER, arrival_id INTEGER,"
-                   " stop_list_id INTEGER, offset INTEGER);\n")
-    for trip_id, tup in stop_times.items():
-        arrival_id, stop_list_id, offset = tup
-        out_file.write("INSERT INTO stop_times VALUES (%d, %d, %d, %d);\n" % (
-            trip_id_map[trip_id], arrival_id, stop_list_id, offset
-        ))
+def write_arrivals_table(writer, arrivals_map):
+    """duration is arrivals_duration of the blob, so queries can skip trips which are over without decoding it"""
+    writer.execute("CREATE TABLE IF NOT EXISTS arrivals (id INTEGER PRIMARY KEY, blob STRING, duration INTEGER)")
+    writer.insert_rows("arrivals", ((arrival_id, encode_arrivals(lst), arrivals_duration([arrival for arrival, departure in lst]))
+                                    for arrival_id, lst in arrivals_map.items()))
 
-def write_arrivals_table(out_file, arrivals_map):
-    out_file.write("CREATE TABLE IF NOT EXISTS arrivals (id INTEGER PRIMARY KEY, blob STRING);\n")
-    for arrival_id, lst in arrivals_map.items():
-        box = Box()
-        box.add_short(len(lst))
-
-        for arrival_seconds, departure_seconds in lst:
-            if arrival_seconds % 60 != 0:
-                raise Exception("arrival_seconds % 60 != 0")
-            if (arrival_seconds / 60) > 0xffff or arrival_seconds < 0:
-                raise Exception("arrival_seconds out of range")
-            box.add_short(arrival_seconds/60)
-            #box.add_int(departure_seconds)
-
-        out_file.write("INSERT INTO arrivals VALUES (%d, %s);\n" % (
-            arrival_id, box.get_blob_string()
-        ))
-
-def write_stop_list_table(out_file, stop_list_map):
-    out_file.write("CREATE TABLE IF NOT EXISTS trip_stops (id INTEGER PRIMARY KEY, blob STRING);\n")
+def stop_ids_in(stop_list_map):
+    for lst in stop_list_map.values():
+        for stop_id, sequence in lst:
+            yield stop_id
+
+def stop_list_rows(stop_list_map, stop_index_map):
     for stop_list_id, lst in stop_list_map.items():
-        box = Box()
-        box.add_short(len(lst))
+        yield stop_list_id, encode_stop_list(lst, stop_index_map)
 
-        for stop_id, sequence in lst:
-            try:
-                box.add_string(stop_id)
-                box.add_short(sequence)
-            except:
-                print((stop_id, sequence))
-                raise
+def write_stop_list_table(writer, stop_list_map, stop_index_map):
+    writer.execute("CREATE TABLE IF NOT EXISTS trip_stops (id INTEGER PRIMARY KEY, blob STRING)")
+    writer.insert_rows("trip_stops", stop_list_rows(stop_list_map, stop_index_map))
 
-        out_file.write("INSERT INTO trip_stops VALUES (%d, %s);\n" % (
-            stop_list_id, box.get_blob_string()
-        ))
+def stop_patterns_rows(stop_list_map, stop_index_map, id_map=None):
+    """yields (stop index, stop_list_id, position in the stop list) for each stop of each stop list.
+    id_map optionally maps stop_list_map ids to the ids in the database"""
+    for stop_list_id, lst in stop_list_map.items():
+        if id_map is not None:
+            stop_list_id = id_map[stop_list_id]
+        for position, (stop_id, sequence) in enumerate(lst):
+            yield stop_index_map[stop_id], stop_list_id, position
+
+def write_stop_patterns_table(writer, rows):
+    """stop_patterns is a reverse index from a stop to the stop lists it's in,
+    so a query for one stop doesn't need to decode every stop list"""
+    writer.execute("CREATE TABLE IF NOT EXISTS stop_patterns (stop_id INTEGER, stop_list_id INTEGER, position INTEGER)")
+    writer.insert_rows("stop_patterns", rows)
+    writer.execute("CREATE INDEX IF NOT EXISTS stop_patterns_stop_id ON stop_patterns (stop_id)")
+
+def assign_pattern_ids(rows, existing, next_id):
+    """rows is (new_id, blob) from arrivals_rows or stop_list_rows, existing is blob -> id in the old database.
+    Returns (new_id -> id in the database, list of (id, blob) rows to insert)"""
+    id_map = {}
+    to_insert = []
+    for new_id, blob in rows:
+        if blob in existing:
+            id_map[new_id] = existing[blob]
+        else:
+            existing[blob] = next_id
+            id_map[new_id] = next_id
+            to_insert.append((next_id, blob))
+            next_id += 1
+    return id_map, to_insert
+
+# the files the database is made from, see write_feed_files_table
+FEED_FILES = ("trips.txt", "stop_times.txt", "calendar.txt", "calendar_dates.txt")
+
+def feed_file_hashes(path):
+    """Returns file name -> parse_cache.file_hash for each of FEED_FILES, or None for a file which is missing"""
+    ret = {}
+    for name in FEED_FILES:
+        file_path = os.path.join(path, name)
+        ret[name] = file_hash(file_path) if feed_file_exists(file_path) else None
+    return ret
+
+def write_feed_files_table(writer, hashes):
+    """feed_files has the hash of each file the database was made from,
+    so update_database can tell which ones changed"""
+    writer.execute("CREATE TABLE IF NOT EXISTS feed_files (name TEXT PRIMARY KEY, hash TEXT)")
+    writer.insert_rows("feed_files", sorted(hashes.items()))
+
+def read_feed_files_table(cur):
+    """The hashes from write_feed_files_table, or an empty dict for a database made before the table was added"""
+    if cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'feed_files'").fetchone() is None:
+        return {}
+    return dict(cur.execute("SELECT name, hash FROM feed_files"))
+
+def count_stop_times(compressed_stop_times, arrivals_map):
+    """Number of rows in stop_times.txt, for the profile report"""
+    return sum(len(arrivals_map[arrival_id]) for arrival_id, stop_list_id, offset in compressed_stop_times.values())
+
+def update_database(path, db_path, jobs=1, profile=None, cache=None):
+    """Updates a database made by a previous run of this script to match the GTFS data in path,
+    only writing rows which changed.
+
+    Arrivals, stop lists, stops, routes, services and trips already in the database keep their ids. Each trip is compared
+    by its route, service and (arrivals blob, stop list blob, offset), and only added, changed or removed trips have their
+    trip_ids rows written. Runs are rebuilt from the per-trip patterns and only runs which differ from
+    the old ones are written to stop_times. Patterns no trip uses anymore are deleted.
+
+    The hashes in feed_files are compared first. If no file changed nothing else is read, and if stop_times.txt
+    didn't change it isn't parsed again and each trip keeps the pattern it has in the database.
+    """
+    if profile is None:
+        profile = BuildProfile()
+    con = sqlite3.connect(db_path)
+    try:
+        cur = con.cursor()
+        with profile.phase("hash_files"):
+            hashes = feed_file_hashes(path)
+            old_hashes = read_feed_files_table(cur)
+        if hashes == old_hashes:
+            print("No files changed since the database was made")
+            return
+        with profile.phase("read_trips") as phase:
+            trips = list(read_trips(os.path.join(path, "trips.txt"), cache))
+            phase["rows"] = len(trips)
+        with profile.phase("read_calendar") as phase:
+            calendar = ServiceCalendar.from_gtfs(path, cache)
+            phase["rows"] = len(calendar.bits)
+
+        reuse_patterns = hashes["stop_times.txt"] == old_hashes.get("stop_times.txt")
+        if reuse_patterns:
+            # rows in stop_times.txt for trips which weren't in trips.txt before were skipped, so they aren't
+            # in the database. If one of those trips was added the file has to be parsed again
+            old_trip_ids = set(str(trip_id) for (trip_id,) in cur.execute("SELECT trip_id FROM trip_ids"))
+            reuse_patterns = all(trip_id in old_trip_ids for trip_id, route_id, service_id in trips)
+        with profile.phase("compress_stop_times") as phase:
+            if reuse_patterns:
+                print("stop_times.txt hasn't changed, using the patterns already in the database")
+                compressed_stop_times, arrivals_map, stop_list_map = {}, {}, {}
+            else:
+                compressed_stop_times, arrivals_map, stop_list_map = compress_stop_times_file(
+                    os.path.join(path, "stop_times.txt"), jobs, cache)
+            phase["rows"] = count_stop_times(compressed_stop_times, arrivals_map)
+            phase["trips"] = len(compressed_stop_times)
+
+        with profile.phase("load_database"):
+            old_trips = {}
+            for db_id, trip_id, route_index, service_index in cur.execute(
+                    "SELECT id, trip_id, route_id, service_id FROM trip_ids"):
+                old_trips[str(trip_id)] = db_id, (route_index, service_index)
+            route_index_map = dict((str(route_id), index) for index, route_id in cur.execute("SELECT id, route_id FROM route_ids"))
+            new_routes = add_string_ids(route_index_map, (route_id for trip_id, route_id, service_id in trips))
+            old_services = {}
+            for row in cur.execute("SELECT id, service_id, start_date, days FROM services"):
+                old_services[row[0]] = (row[1], row[2], bytes(row[3]))
+            service_index_map = dict((service_id, index) for index, (service_id, start_date, days) in old_services.items())
+            add_string_ids(service_index_map, (service_id for trip_id, route_id, service_id in trips))
+            changed_services = [row for row in services_rows(calendar, service_index_map)
+                                if old_services.get(row[0]) != row[1:]]
+            stop_index_map = dict((str(stop_id), index) for index, stop_id in cur.execute("SELECT id, stop_id FROM stop_ids"))
+            new_stops = add_string_ids(stop_index_map, stop_ids_in(stop_list_map))
+            old_runs = {}
+            for row in cur.execute("SELECT trip_id, arrival_id, stop_list_id, offset, headway, count FROM stop_times"):
+                old_runs[row[0]] = tuple(row[1:])
+            old_stop_times = expand_runs(old_runs)
+            old_arrivals = dict((bytes(blob), arrival_id) for arrival_id, blob in cur.execute("SELECT id, blob FROM arrivals"))
+            old_stop_lists = dict((bytes(blob), stop_list_id) for stop_list_id, blob in cur.execute("SELECT id, blob FROM trip_stops"))
+
+        with profile.phase("diff"):
+            next_arrival_id = cur.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM arrivals").fetchone()[0]
+            arrival_id_map, new_arrivals = assign_pattern_ids(arrivals_rows(arrivals_map), old_arrivals, next_arrival_id)
+            next_stop_list_id = cur.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM trip_stops").fetchone()[0]
+            stop_list_id_map, new_stop_lists = assign_pattern_ids(stop_list_rows(stop_list_map, stop_index_map),
+                                                                  old_stop_lists, next_stop_list_id)
+
+            next_trip_id = cur.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM trip_ids").fetchone()[0]
+            patterns = {}
+            if reuse_patterns:
+                for trip_id, (db_id, indexes) in old_trips.items():
+                    if db_id in old_stop_times:
+                        patterns[trip_id] = old_stop_times[db_id]
+            for trip_id, (arrival_id, stop_list_id, offset) in compressed_stop_times.items():
+                patterns[trip_id] = arrival_id_map[arrival_id], stop_list_id_map[stop_list_id], offset
+
+            new_trips = []
+            changed_trip_rows = []
+            changed_count = 0
+            # trips_ids.id -> pattern for every trip in the new feed
+            trip_patterns = {}
+            seen = set()
+            for trip_id, route_id, service_id in trips:
+                seen.add(trip_id)
+                indexes = route_index_map[route_id], service_index_map[service_id]
+                if trip_id in old_trips:
+                    db_id, old_indexes = old_trips[trip_id]
+                    if old_indexes != indexes:
+                        changed_trip_rows.append(indexes + (db_id,))
+                    if patterns.get(trip_id) != old_stop_times.get(db_id):
+                        changed_count += 1
+                    if trip_id in patterns:
+                        trip_patterns[db_id] = patterns[trip_id]
+                else:
+                    new_trips.append((trip_id, indexes))
+
+            # number new trips the same way write_trip_ids_table does so they form runs
+            new_trips.sort(key=lambda tup: pattern_sort_key(patterns.get(tup[0])))
+            new_trip_rows = []
+            for trip_id, indexes in new_trips:
+                db_id = next_trip_id
+                next_trip_id += 1
+                new_trip_rows.append((db_id, trip_id) + indexes)
+                if trip_id in patterns:
+                    trip_patterns[db_id] = patterns[trip_id]
+
+            removed_ids = [(db_id,) for trip_id, (db_id, indexes) in old_trips.items() if trip_id not in seen]
+
+            runs = build_runs(trip_patterns)
+            stale_runs = [(first_id,) for first_id, run in old_runs.items() if runs.get(first_id) != run]
+            new_runs = [(first_id,) + run for first_id, run in runs.items() if old_runs.get(first_id) != run]
+
+        with profile.phase("write", lambda: con.total_changes):
+            cur.executemany("DELETE FROM stop_times WHERE trip_id = ?", stale_runs)
+            cur.executemany("DELETE FROM trip_ids WHERE id = ?", removed_ids)
+            cur.executemany("UPDATE trip_ids SET route_id = ?, service_id = ? WHERE id = ?", changed_trip_rows)
+            cur.executemany("INSERT OR REPLACE INTO services VALUES (?, ?, ?, ?)", changed_services)
+            cur.executemany("INSERT INTO route_ids VALUES (?, ?)", new_routes)
+            cur.executemany("INSERT INTO stop_ids VALUES (?, ?)", new_stops)
+            cur.executemany("INSERT INTO trip_ids VALUES (?, ?, ?, ?)", new_trip_rows)
+            if "duration" not in [row[1] for row in cur.execute("PRAGMA table_info(arrivals)")]:
+                # for databases made before the column was added
+                cur.execute("ALTER TABLE arrivals ADD COLUMN duration INTEGER")
+                cur.executemany("UPDATE arrivals SET duration = ? WHERE id = ?",
+                                [(arrivals_duration(decode_arrivals(blob)[0]), arrival_id)
+                                 for arrival_id, blob in cur.execute("SELECT id, blob FROM arrivals").fetchall()])
+            cur.executemany("INSERT INTO arrivals VALUES (?, ?, ?)",
+                            ((arrival_id, blob, arrivals_duration(decode_arrivals(blob)[0])) for arrival_id, blob in new_arrivals))
+            cur.executemany("INSERT INTO trip_stops VALUES (?, ?)", new_stop_lists)
+            cur.executemany("INSERT INTO stop_times VALUES (?, ?, ?, ?, ?, ?)", new_runs)
+            new_stop_list_ids = set(stop_list_id for stop_list_id, blob in new_stop_lists)
+            cur.executemany("INSERT INTO stop_patterns VALUES (?, ?, ?)",
+                            (row for row in stop_patterns_rows(stop_list_map, stop_index_map, stop_list_id_map)
+                             if row[1] in new_stop_list_ids))
+            cur.execute("DELETE FROM arrivals WHERE id NOT IN (SELECT arrival_id FROM stop_times)")
+            cur.execute("DELETE FROM trip_stops WHERE id NOT IN (SELECT stop_list_id FROM stop_times)")
+            cur.execute("DELETE FROM stop_patterns WHERE stop_list_id NOT IN (SELECT id FROM trip_stops)")
+            # for databases made before the index was added
+            cur.execute("CREATE INDEX IF NOT EXISTS trip_ids_trip_id ON trip_ids (trip_id)")
+            cur.execute("CREATE TABLE IF NOT EXISTS feed_files (name TEXT PRIMARY KEY, hash TEXT)")
+            cur.executemany("INSERT OR REPLACE INTO feed_files VALUES (?, ?)", sorted(hashes.items()))
+            con.commit()
+    finally:
+        con.close()
+
+    print("%d trips added, %d removed, %d changed, %d runs rewritten, %d new arrivals, %d new stop lists, "
+          "%d new stops, %d new routes, %d services changed" % (
+              len(new_trip_rows), len(removed_ids), changed_count + len(changed_trip_rows), len(new_runs),
+              len(new_arrivals), len(new_stop_lists), len(new_stops), len(new_routes),
+              len(changed_services)))
+
+def build_database(path, writer, jobs=1, profile=None, cache=None):
+    """Writes every table for the GTFS data in path with writer, see db_writer. Each table is a phase in profile.
+    cache is a parse_cache.ParseCache or None"""
+    if profile is None:
+        profile = BuildProfile()
+    written = lambda: writer.rows_written
+    writer.begin()
+    with profile.phase("compress_stop_times") as phase:
+        compressed_stop_times, arrivals_map, stop_list_map = compress_stop_times_file(
+            os.path.join(path, "stop_times.txt"), jobs, cache)
+        phase["rows"] = count_stop_times(compressed_stop_times, arrivals_map)
+        phase["trips"] = len(compressed_stop_times)
+        phase["arrivals"] = len(arrivals_map)
+        phase["stop_lists"] = len(stop_list_map)
+    route_index_map = {}
+    service_index_map = {}
+    with profile.phase("trip_ids", written):
+        trip_ids_map = write_trip_ids_table(writer, os.path.join(path, "trips.txt"), route_index_map,
+                                            service_index_map, compressed_stop_times, cache)
+    with profile.phase("route_ids", written):
+        write_string_ids_table(writer, "route_ids", "route_id", route_index_map)
+    with profile.phase("services", written):
+        write_services_table(writer, ServiceCalendar.from_gtfs(path, cache), service_index_map)
+    with profile.phase("stop_times", written):
+        write_stop_times_table(writer, build_runs(dict((trip_ids_map[trip_id], pattern)
+                                                       for trip_id, pattern in compressed_stop_times.items())))
+    with profile.phase("arrivals", written):
+        write_arrivals_table(writer, arrivals_map)
+    with profile.phase("stop_ids", written):
+        stop_index_map = {}
+        add_string_ids(stop_index_map, stop_ids_in(stop_list_map))
+        write_string_ids_table(writer, "stop_ids", "stop_id", stop_index_map)
+    with profile.phase("trip_stops", written):
+        write_stop_list_table(writer, stop_list_map, stop_index_map)
+    with profile.phase("stop_patterns", written):
+        write_stop_patterns_table(writer, stop_patterns_rows(stop_list_map, stop_index_map))
+    with profile.phase("feed_files", written):
+        write_feed_files_table(writer, feed_file_hashes(path))
+    with profile.phase("commit"):
+        writer.commit()
 
 def main():
     parser = argparse.ArgumentParser(description='Parses GTFS data into general schedule')
-    parser.add_argument('path', help='Path of directory containing GTFS data')
-    parser.add_argument('output_file', help='File to write SQL output to')
+    parser.add_argument('path', help='Path of directory or .zip file containing GTFS data')
+    parser.add_argument('output_file', help='File to write the SQLite database (or SQL output) to')
+    parser.add_argument('--format', choices=['sqlite', 'sql'], default='sqlite',
+                        help='sqlite writes the database directly, sql writes SQL statements '
+                             'to be replayed with the sqlite3 command line tool')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes to use when parsing stop_times.txt')
+    parser.add_argument('--update', action='store_true',
+                        help='Update an existing database made from a previous version of the feed '
+                             'in place, only writing what changed')
+    add_profile_arguments(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    if not os.path.isdir(args.path):
-        print("%s is not a valid directory" % args.path)
+    if not is_feed(args.path):
+        print("%s is not a valid directory or zip file" % args.path)
         exit(-1)
 
+    if args.update:
+        if args.format != 'sqlite':
+            print("--update only works with --format sqlite")
+            exit(-1)
+        if not os.path.exists(args.output_file):
+            print("Database %s doesn't exist, run without --update to create it" % args.output_file)
+            exit(-1)
+        profile = profile_from_args(args)
+        update_database(args.path, args.output_file, args.jobs, profile, cache_from_args(args))
+        finish_profile(profile, args)
+        return
+
     if os.path.exists(args.output_file):
         print("Output file %s already exists, delete it and try again" % args.output_file)
         exit(-1)
 
-    with open(args.output_file, "w") as f:
-        f.write("BEGIN TRANSACTION;\n")
-        trip_ids_map = write_trip_ids_table(f, os.path.join(args.path, "trips.txt"))
-        stop_times = read_stop_times_table(os.path.join(args.path, "stop_times.txt"))
-        compressed_stop_times, arrivals_map, stop_list_map = compress_stop_times_table(stop_times)
-        write_stop_times_table(f, compressed_stop_times, trip_ids_map)
-        write_arrivals_table(f, arrivals_map)
-        write_stop_list_table(f, stop_list_map)
-
-        f.write("END TRANSACTION;\n")
+    profile = profile_from_args(args)
+    writer = open_writer(args.output_file, args.format)
+    try:
+        build_database(args.path, writer, args.jobs, profile, cache_from_args(args))
+    finally:
+        writer.close()
+    finish_profile(profile, args)
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
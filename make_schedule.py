@@ -2,11 +2,27 @@
 
 import argparse
 import os
-import csv
 from collections import defaultdict, OrderedDict
-from time import strptime
-from datetime import date
 
+from chunked_reader import (
+    iter_runs,
+)
+from feed_files import is_feed
+from make_database import read_stop_times_runs
+from parse_cache import (
+    add_cache_arguments,
+    cache_from_args,
+    read_csv_table,
+)
+from profiling import (
+    BuildProfile,
+    add_profile_arguments,
+    finish_profile,
+    profile_from_args,
+)
+from services import (
+    parse_date,
+)
 from schedules import (
     Schedule,
     StopSchedule,
@@ -16,14 +32,13 @@ from util import (
     parse_time,
 )
 
-def read_map(path, key):
+def read_map(path, key, cache=None):
     ret = {}
 
-    with open(path) as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            ret[row[key]] = row
+    header, rows = read_csv_table(path, cache)
+    for row in rows:
+        row = dict(zip(header, row))
+        ret[row[key]] = row
 
     return ret
 
@@ -43,11 +58,9 @@ def make_days_hash(arr):
 def duration(calendar, service):
     row = calendar[service]
 
-    end_tup = strptime(row['end_date'], '%Y%m%d')
-    start_tup = strptime(row['start_date'], '%Y%m%d')
-
-    end = date(end_tup[0], end_tup[1], end_tup[2])
-    start = date(start_tup[0], start_tup[1], start_tup[2])
+    # parse_date is memoized so this doesn't reparse dates on every comparison
+    end = parse_date(row['end_date'])
+    start = parse_date(row['start_date'])
     return (end-start).days
 
 def convert_service_to_weekdays(ret_with_service, calendar):
@@ -78,15 +91,38 @@ def convert_service_to_weekdays(ret_with_service, calendar):
                     ret_with_stops[route][direction][weekdays_to_name(tup)] = sched
     return ret_with_stops
 
-def parse(path):
-    print("reading routes...")
-    routes = read_map(os.path.join(path, "routes.txt"), "route_id")
-    print("reading stops...")
-    stops = read_map(os.path.join(path, "stops.txt"), "stop_id")
-    print("reading trips...")
-    trips = read_map(os.path.join(path, "trips.txt"), "trip_id")
-    print("reading calendar...")
-    calendar = read_map(os.path.join(path, "calendar.txt"), "service_id")
+def make_stop_times_row_parser(header):
+    """returns a function turning a stop_times.txt row into (trip_id, (arrival_time, stop_id))"""
+    trip_id_index = header["trip_id"]
+    stop_id_index = header["stop_id"]
+    arrival_index = header["arrival_time"]
+
+    def parse_row(row):
+        return row[trip_id_index], (parse_time(row[arrival_index]), row[stop_id_index])
+    return parse_row
+
+def read_map_phase(profile, cache, path, name, key):
+    print("reading %s..." % name)
+    with profile.phase("read_" + name) as phase:
+        ret = read_map(os.path.join(path, name + ".txt"), key, cache)
+        phase["rows"] = len(ret)
+    return ret
+
+def iter_stop_times(path, jobs=1, cache=None):
+    """Yields (trip_id, [(arrival_time, stop_id), ...]) runs from stop_times.txt.
+    With a cache this shares make_database's snapshot of the file, see parse_cache"""
+    if cache is None:
+        return iter_runs(path, make_stop_times_row_parser, jobs)
+    return ((trip_id, [(arrival, stop_id) for stop_id, sequence, arrival, departure in stop_lst])
+            for trip_id, stop_lst in read_stop_times_runs(path, jobs, cache))
+
+def parse(path, jobs=1, profile=None, cache=None):
+    if profile is None:
+        profile = BuildProfile()
+    routes = read_map_phase(profile, cache, path, "routes", "route_id")
+    stops = read_map_phase(profile, cache, path, "stops", "stop_id")
+    trips = read_map_phase(profile, cache, path, "trips", "trip_id")
+    calendar = read_map_phase(profile, cache, path, "calendar", "service_id")
 
     
 
@@ -94,28 +130,30 @@ def parse(path):
     # mapping of (stop, direction) to list of (start_time, increment, count)
     schedule = defaultdict(Schedule)
 
-    with open(os.path.join(path, "stop_times.txt")) as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            trip = row["trip_id"]
+    with profile.phase("read_stop_times") as phase:
+        rows = 0
+        for trip, times in iter_stop_times(os.path.join(path, "stop_times.txt"), jobs, cache):
             key = trips[trip]["trip_headsign"], trips[trip]["route_id"], trips[trip]["service_id"]
 
             sched = schedule[key]
             sched.trip = trip
 
-            arrival_time = parse_time(row["arrival_time"])
-            sched.add_time(arrival_time, row["stop_id"])
-        
+            for arrival_time, stop_id in times:
+                sched.add_time(arrival_time, stop_id)
+            rows += len(times)
+        phase["rows"] = rows
+
     # mapping route -> direction -> service -> sched
     ret_with_service = defaultdict(lambda: defaultdict(dict))
 
-    for key, sched in schedule.items():
-        direction, route, service = key
+    with profile.phase("compress") as phase:
+        for key, sched in schedule.items():
+            direction, route, service = key
 
-        ret_with_service[route][direction][service] = sched
+            ret_with_service[route][direction][service] = sched
 
-        sched.compress()
+            sched.compress()
+        phase["rows"] = len(schedule)
 
     #ret = convert_service_to_weekdays(ret_with_service, calendar)
 
@@ -138,13 +176,17 @@ def weekdays_to_name(weekdays):
 
 def main():
     parser = argparse.ArgumentParser(description='Parses GTFS data into general schedule')
-    parser.add_argument('path', help='Path of directory containing GTFS data')
+    parser.add_argument('path', help='Path of directory or .zip file containing GTFS data')
     parser.add_argument('output_file', help='File to output schedule to')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes to use when parsing stop_times.txt')
+    add_profile_arguments(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    if not os.path.isdir(args.path):
-        print("%s is not a valid directory" % args.path)
+    if not is_feed(args.path):
+        print("%s is not a valid directory or zip file" % args.path)
         exit(-1)
 
     if os.path.exists(args.output_file):
@@ -155,15 +197,18 @@ def main():
         # test that we can write
         f.write("\n")
 
-        schedule, trips, calendar = parse(args.path)
-
-        for route, direction_map in schedule.items():
-            f.write("Route: %s\n" % route)
-            for direction, service_map in direction_map.items():
-                f.write("    Direction: %s\n" % direction)
-                for service, sched in service_map.items():
-                    f.write("    Service: %s\n" % service)
-                    f.write("    Schedule: %s\n" % str(sched))
+        profile = profile_from_args(args)
+        schedule, trips, calendar = parse(args.path, args.jobs, profile, cache_from_args(args))
+
+        with profile.phase("write"):
+            for route, direction_map in schedule.items():
+                f.write("Route: %s\n" % route)
+                for direction, service_map in direction_map.items():
+                    f.write("    Direction: %s\n" % direction)
+                    for service, sched in service_map.items():
+                        f.write("    Service: %s\n" % service)
+                        f.write("    Schedule: %s\n" % str(sched))
+    finish_profile(profile, args)
 
 if __name__ == "__main__":
     main()
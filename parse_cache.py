@@ -0,0 +1,196 @@
+__author__ = 'schneg'
+
+import csv
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from array import array
+
+from feed_files import (
+    open_binary,
+    open_text,
+)
+
+# Parsed GTFS tables are saved in a cache directory under a hash of the file they came from, so rerunning
+# make_database.py or make_schedule.py on the same feed skips parsing files which haven't changed.
+# Both scripts store the same kinds of snapshots, so either one can use what the other parsed.
+
+# Bump these when the format of a snapshot or the parsing behind it changes, old entries are then ignored
+# and eventually evicted
+SNAPSHOT_VERSIONS = {
+    "csv": 1,
+    "stop_times": 1,
+}
+
+SUFFIX = ".snapshot"
+DEFAULT_MAX_MEGABYTES = 1024
+DEFAULT_MAX_AGE_DAYS = 30
+
+def file_hash(path):
+    """Hash of the contents of a feed file, also for files inside a zip"""
+    h = hashlib.blake2b(digest_size=20)
+    with open_binary(path) as f:
+        while True:
+            data = f.read(1 << 20)
+            if len(data) == 0:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+class ParseCache:
+    """A directory of snapshots keyed by the kind of snapshot and the hash of the input file.
+
+    Entries are touched when they're used. After something is stored, entries older than max_age_days
+    are deleted, then the least recently used ones until the directory is under max_bytes.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_MEGABYTES * 1024 * 1024, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, kind, path):
+        return os.path.join(self.directory, "%s-%d-%s%s" % (kind, SNAPSHOT_VERSIONS[kind], file_hash(path), SUFFIX))
+
+    def get(self, kind, path, parse):
+        """Returns the snapshot of kind for the file at path, calling parse() and storing what it returns
+        if there isn't one yet"""
+        entry_path = self.entry_path(kind, path)
+        try:
+            with open(entry_path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            value = None
+        except Exception as e:
+            # truncated or from an incompatible Python, parse again
+            print("Ignoring unreadable cache entry %s: %s" % (entry_path, e))
+            value = None
+
+        if value is not None:
+            self.hits += 1
+            os.utime(entry_path)
+            return value
+
+        self.misses += 1
+        value = parse()
+        self.store(entry_path, value)
+        return value
+
+    def store(self, entry_path, value):
+        # write somewhere else first so another process never reads half an entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, entry_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        oldest = time.time() - self.max_age_days * 24 * 60 * 60
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            entry_path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(entry_path)
+                if stat.st_mtime < oldest:
+                    os.remove(entry_path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry_path))
+            except FileNotFoundError:
+                # another process evicted it first
+                pass
+
+        total = sum(size for mtime, size, entry_path in entries)
+        for mtime, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def read_csv_table(path, cache=None):
+    """Returns (header, rows) for a CSV file, where rows is a list of lists of strings"""
+    def parse():
+        with open_text(path) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            return header, list(reader)
+    if cache is None:
+        return parse()
+    return cache.get("csv", path, parse)
+
+class StopTimesSnapshot:
+    """stop_times.txt as (trip_id, [(stop_id, sequence, arrival, departure), ...]) runs in file order,
+    see make_database.read_stop_times_runs. Rows are kept in flat int arrays with stop ids interned,
+    so it's much smaller than the tuples and quick to pickle"""
+    def __init__(self):
+        # one entry per run
+        self.trip_ids = []
+        self.run_lengths = array('i')
+        self.stop_ids = []
+        # one entry per row
+        self.stop_indexes = array('i')
+        self.sequences = array('i')
+        self.arrivals = array('i')
+        self.departures = array('i')
+
+    @classmethod
+    def from_runs(cls, runs):
+        ret = cls()
+        stop_index_map = {}
+        for trip_id, stop_lst in runs:
+            if len(ret.trip_ids) > 0 and ret.trip_ids[-1] == trip_id:
+                # a trip split across two byte ranges, see chunked_reader.iter_runs
+                ret.run_lengths[-1] += len(stop_lst)
+            else:
+                ret.trip_ids.append(trip_id)
+                ret.run_lengths.append(len(stop_lst))
+            for stop_id, sequence, arrival, departure in stop_lst:
+                stop_index = stop_index_map.get(stop_id)
+                if stop_index is None:
+                    stop_index = len(ret.stop_ids)
+                    stop_index_map[stop_id] = stop_index
+                    ret.stop_ids.append(stop_id)
+                ret.stop_indexes.append(stop_index)
+                ret.sequences.append(sequence)
+                ret.arrivals.append(arrival)
+                ret.departures.append(departure)
+        return ret
+
+    def runs(self):
+        stop_ids = self.stop_ids
+        start = 0
+        for trip_id, length in zip(self.trip_ids, self.run_lengths):
+            end = start + length
+            yield trip_id, [(stop_ids[stop_index], sequence, arrival, departure)
+                            for stop_index, sequence, arrival, departure in zip(
+                                self.stop_indexes[start:end], self.sequences[start:end],
+                                self.arrivals[start:end], self.departures[start:end])]
+            start = end
+
+def add_cache_arguments(parser):
+    """Adds --cache-dir, --cache-max-size and --cache-max-age to an argparse parser"""
+    parser.add_argument('--cache-dir',
+                        help='Directory to keep parsed GTFS files in, so unchanged files are not parsed again. '
+                             'make_database.py and make_schedule.py can share one')
+    parser.add_argument('--cache-max-size', type=int, default=DEFAULT_MAX_MEGABYTES,
+                        help='Size in MB above which the least recently used cache entries are deleted')
+    parser.add_argument('--cache-max-age', type=float, default=DEFAULT_MAX_AGE_DAYS,
+                        help='Days after which unused cache entries are deleted')
+
+def cache_from_args(args):
+    """Returns a ParseCache, or None if --cache-dir wasn't given"""
+    if args.cache_dir is None:
+        return None
+    return ParseCache(args.cache_dir, args.cache_max_size * 1024 * 1024, args.cache_max_age)
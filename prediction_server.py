@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import json
+import math
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from feed_client import (
+    DEFAULT_MAX_BACKOFF,
+    DEFAULT_TIMEOUT,
+    FeedPoller,
+    check_feeds,
+    make_sources,
+)
+from predictions import (
+    PredictionTable,
+    ScheduleIndex,
+    arrival_to_json,
+)
+from realtime import (
+    MBTA_FEED_URL,
+    FeedState,
+    combine_states,
+    parse_message,
+)
+
+# Twisted runs on the asyncio event loop so the feeds can be polled with feed_client.py.
+# This has to happen before anything imports twisted.internet.reactor
+from twisted.internet import asyncioreactor
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+asyncioreactor.install(loop)
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+# A long running version of print_updates.py. The database is loaded into memory once, the GTFS-realtime feeds
+# are polled with feed_client.FeedPoller and after each poll the arrivals at every stop are worked out in advance,
+# so a lookup is a dict get and a bisect. Only the trips whose updates changed since the last poll are redone.
+#
+#   python prediction_server.py database.db --port 8080
+#   curl 'http://localhost:8080/arrivals?stop=8178&limit=5'
+
+def seconds_since_midnight(now):
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (now - midnight).seconds
+
+class Predictor:
+    """Keeps the PredictionTable for the trip updates from every source. Pass its methods to FeedPoller.
+
+    Applying a feed and patching the table run in executor, which must have one thread like FeedPoller's,
+    so requests are answered while that happens. The table is patched as a copy and swapped in at the end,
+    so a request always sees a whole table
+    """
+    def __init__(self, index, sources, executor):
+        self.index = index
+        self.sources = sources
+        self.executor = executor
+        self.states = dict((source, FeedState()) for source in sources)
+        # the table requests are answered from, and the newest one, which is only used in executor
+        self.table = None
+        self.latest = None
+        self.realtime_trips = 0
+        self.changed_trips = 0
+        self.last_poll = None
+
+    def make_table(self, changed):
+        """Runs in executor. Returns a table patched for the trips in changed, or built again if the day changed"""
+        today = datetime.now().date()
+        trip_ids, trip_id_to_delays = combine_states([self.states[source] for source in self.sources])
+        self.realtime_trips = len(trip_ids)
+        if self.latest is None or self.latest.today != today:
+            self.latest = PredictionTable.build(self.index, trip_ids, trip_id_to_delays, today)
+        else:
+            table = self.latest.copy()
+            table.patch(self.index, changed, trip_ids, trip_id_to_delays)
+            self.latest = table
+        return self.latest
+
+    def apply(self, source, message):
+        """Runs in executor"""
+        changed = self.states[source].apply_message(message)
+        return self.make_table(changed), len(changed)
+
+    async def on_update(self, source, message):
+        loop = asyncio.get_running_loop()
+        self.table, self.changed_trips = await loop.run_in_executor(self.executor, self.apply, source, message)
+
+    async def on_polled(self, source):
+        self.last_poll = time.time()
+        if self.table is not None and self.table.today != datetime.now().date():
+            # a feed which hasn't changed isn't passed to on_update, but the table still has to move to the new day
+            loop = asyncio.get_running_loop()
+            self.table = await loop.run_in_executor(self.executor, self.make_table, set())
+
+    def on_error(self, source, e):
+        # the last table is kept until a poll works again
+        print("Error polling %s: %s" % (source.url, str(e) or e.__class__.__name__))
+
+class JsonResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        status, body = self.respond(request)
+        request.setResponseCode(status)
+        if isinstance(body, list):
+            # a line of JSON for each item
+            request.setHeader(b"content-type", b"application/x-ndjson")
+            return "".join(json.dumps(item) + "\n" for item in body).encode("utf-8")
+        request.setHeader(b"content-type", b"application/json")
+        return json.dumps(body).encode("utf-8")
+
+    def respond(self, request):
+        raise NotImplementedError
+
+def get_arg(request, name):
+    values = request.args.get(name.encode("utf-8"))
+    if not values:
+        return None
+    return values[0].decode("utf-8")
+
+def get_window(request, now_seconds):
+    """The end of the window for the window parameter in minutes, raises ValueError if it isn't a finite number"""
+    window = get_arg(request, "window")
+    if window is None:
+        return None
+    window = float(window)
+    if not math.isfinite(window):
+        raise ValueError("window must be finite")
+    return now_seconds + int(window * 60)
+
+def read_query(request):
+    """Returns (now_seconds, limit, end_seconds) for the parameters /arrivals and /boards share.
+    Raises ValueError with the error for the response if one of them is wrong"""
+    limit = get_arg(request, "limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError("limit must be a number")
+        if limit < 0:
+            raise ValueError("limit can't be negative")
+    now_seconds = seconds_since_midnight(datetime.now())
+    try:
+        end_seconds = get_window(request, now_seconds)
+    except ValueError:
+        raise ValueError("window must be a finite number")
+    return now_seconds, limit, end_seconds
+
+class ArrivalsResource(JsonResource):
+    """GET /arrivals?stop=STOP_ID&limit=N&window=MINUTES returns the next arrivals at a stop, soonest first"""
+    def __init__(self, predictor):
+        Resource.__init__(self)
+        self.predictor = predictor
+
+    def respond(self, request):
+        stop_id = get_arg(request, "stop")
+        if stop_id is None:
+            return 400, {"error": "stop is required"}
+        try:
+            now_seconds, limit, end_seconds = read_query(request)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        table = self.predictor.table
+        if table is None:
+            return 503, {"error": "no GTFS-realtime data yet"}
+
+        arrivals = table.next_arrivals(stop_id, now_seconds, limit, end_seconds)
+        return 200, {
+            "stop_id": stop_id,
+            "updated": self.predictor.last_poll,
+            "arrivals": [arrival_to_json(arrival) for arrival in arrivals],
+        }
+
+class BoardsResource(JsonResource):
+    """GET /boards?stop=A&stop=B&limit=N&window=MINUTES returns the next arrivals for several stops, a line of JSON
+    per stop in the same format as print_updates.py --json. Errors are the same as /arrivals"""
+    def __init__(self, predictor):
+        Resource.__init__(self)
+        self.predictor = predictor
+
+    def respond(self, request):
+        stop_ids = [value.decode("utf-8") for value in request.args.get(b"stop", [])]
+        if len(stop_ids) == 0:
+            return 400, {"error": "stop is required"}
+        try:
+            now_seconds, limit, end_seconds = read_query(request)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        table = self.predictor.table
+        if table is None:
+            return 503, {"error": "no GTFS-realtime data yet"}
+
+        lines = []
+        for stop_id in stop_ids:
+            arrivals = table.next_arrivals(stop_id, now_seconds, limit, end_seconds)
+            lines.append({"stop_id": stop_id, "arrivals": [arrival_to_json(arrival) for arrival in arrivals]})
+        return 200, lines
+
+def source_status(source):
+    return {
+        "feed": source.url,
+        "polls": source.polls,
+        "processed": source.processed,
+        "skipped": source.skipped,
+        "errors": source.errors,
+        "last_poll": source.last_poll,
+        "last_error": source.last_error,
+    }
+
+class StatusResource(JsonResource):
+    """GET /status returns when each feed was last polled and how many polls failed or were skipped"""
+    def __init__(self, predictor):
+        Resource.__init__(self)
+        self.predictor = predictor
+
+    def respond(self, request):
+        predictor = self.predictor
+        feeds = [source_status(source) for source in predictor.sources]
+        ret = {
+            "feeds": feeds,
+            "last_poll": predictor.last_poll,
+            "trips": len(predictor.index.trips),
+            "realtime_trips": predictor.realtime_trips,
+            "changed_trips": predictor.changed_trips,
+            "entities_decoded": sum(state.entities_decoded for state in predictor.states.values()),
+            "stops": len(predictor.table.arrivals_by_stop) if predictor.table is not None else 0,
+        }
+        # totals over every feed
+        for name in ("polls", "processed", "skipped", "errors"):
+            ret[name] = sum(feed[name] for feed in feeds)
+        return 200, ret
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve predicted arrivals for every stop over HTTP as JSON')
+    parser.add_argument("db", help="Path to sqlite3 database generated by make_database.py")
+    parser.add_argument("--feed", action="append", nargs="+", metavar="URL [SECONDS]",
+                        help="URL of a GTFS-realtime feed, or a file to read it from instead. Give it more than once "
+                             "to use several feeds. SECONDS is how often to poll this one. Defaults to the MBTA's feed")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between polls of each feed")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Seconds to wait for each feed")
+    parser.add_argument("--max-backoff", type=float, default=DEFAULT_MAX_BACKOFF,
+                        help="The longest to wait before polling a feed again after errors")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--interface", default="127.0.0.1", help="Address to listen on")
+    args = parser.parse_args()
+    check_feeds(parser, args.feed)
+
+    con = sqlite3.connect(args.db)
+    try:
+        index = ScheduleIndex(con)
+    finally:
+        con.close()
+    print("Loaded %d trips from %s" % (len(index.trips), args.db))
+
+    sources = make_sources(args.feed or [[MBTA_FEED_URL]], args.interval, args.timeout)
+    # one thread for decoding feeds and patching the table, so they happen in the order the feeds came in
+    executor = ThreadPoolExecutor(max_workers=1)
+    predictor = Predictor(index, sources, executor)
+    root = Resource()
+    root.putChild(b"arrivals", ArrivalsResource(predictor))
+    root.putChild(b"boards", BoardsResource(predictor))
+    root.putChild(b"status", StatusResource(predictor))
+    reactor.listenTCP(args.port, Site(root), interface=args.interface)
+
+    poller = FeedPoller(sources, parse_message, predictor.on_update, predictor.on_error, executor,
+                        max_backoff=args.max_backoff, on_polled=predictor.on_polled)
+    # starts when the reactor runs the event loop
+    asyncio.ensure_future(poller.run())
+    print("Listening on %s:%d" % (args.interface, args.port))
+    try:
+        reactor.run()
+    finally:
+        poller.close()
+
+if __name__ == "__main__":
+    main()
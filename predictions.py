@@ -0,0 +1,169 @@
+__author__ = 'schneg'
+
+from bisect import bisect_right
+
+from blobs import (
+    decode_arrivals,
+    decode_stop_list,
+)
+from make_database import expand_runs
+from schedules import time_to_string
+from services import (
+    ServiceCalendar,
+    service_days,
+)
+from stop_queries import load_string_ids
+
+# In-memory versions of the stop_queries lookups for prediction_server.py. ScheduleIndex is the static schedule,
+# loaded once. PredictionTable has the arrivals at every stop for one GTFS-realtime update, it's patched after each poll
+# for the trips which changed and rebuilt when the day changes
+
+class ScheduleIndex:
+    """The parts of a make_database.py database needed to make predictions, with every blob decoded"""
+    def __init__(self, con):
+        cur = con.cursor()
+        self.route_ids = load_string_ids(cur, "route_ids", "route_id")
+        self.stop_ids = load_string_ids(cur, "stop_ids", "stop_id")
+        self.calendar = ServiceCalendar.from_rows(cur.execute("SELECT id, start_date, days FROM services"))
+
+        # arrival id -> arrivals in seconds from the start of the trip
+        self.arrivals = {}
+        for arrival_id, blob in cur.execute("SELECT id, blob FROM arrivals"):
+            self.arrivals[arrival_id] = decode_arrivals(blob)[0]
+        # stop list id -> (stop indexes, sequences)
+        self.stop_lists = {}
+        for stop_list_id, blob in cur.execute("SELECT id, blob FROM trip_stops"):
+            self.stop_lists[stop_list_id] = decode_stop_list(blob)
+
+        runs = {}
+        for row in cur.execute("SELECT trip_id, arrival_id, stop_list_id, offset, headway, count FROM stop_times"):
+            runs[row[0]] = tuple(row[1:])
+        patterns = expand_runs(runs)
+
+        # trip_id -> (route index, service index, arrival id, stop list id, offset) for trips with stop times
+        self.trips = {}
+        for db_id, trip_id, route_index, service_index in cur.execute(
+                "SELECT id, trip_id, route_id, service_id FROM trip_ids"):
+            if db_id in patterns:
+                self.trips[str(trip_id)] = (route_index, service_index) + patterns[db_id]
+
+    def is_running(self, service_index, day):
+        if self.calendar.start_date is None:
+            # no calendar in the feed, like stop_queries.service_filter
+            return True
+        return service_index in self.calendar.active_services(day)
+
+class PredictionTable:
+    """stop_id -> arrivals sorted by predicted time, each (predicted seconds, scheduled seconds, delay,
+    route_id, trip_id, stop_sequence)"""
+    def __init__(self, today, arrivals_by_stop, keys=None):
+        self.today = today
+        self.arrivals_by_stop = arrivals_by_stop
+        # predicted seconds for each stop, for bisecting
+        if keys is None:
+            keys = dict((stop_id, [arrival[0] for arrival in arrivals])
+                        for stop_id, arrivals in arrivals_by_stop.items())
+        self.keys = keys
+
+    def copy(self):
+        """A copy which can be patched while this one is still being read. The lists for each stop are shared,
+        patch replaces them rather than changing them"""
+        return PredictionTable(self.today, dict(self.arrivals_by_stop), dict(self.keys))
+
+    @classmethod
+    def build(cls, index, trip_ids, trip_id_to_delays, today):
+        """Predicts the arrival at every stop of every trip in the update which runs today.
+        trip_id_to_delays is trip_id -> delays.TripDelays, see realtime.FeedState.apply"""
+        arrivals_by_stop = {}
+        for trip_id in trip_ids:
+            for stop_id, arrival in trip_arrivals(index, trip_id, trip_id_to_delays, today):
+                if stop_id in arrivals_by_stop:
+                    arrivals_by_stop[stop_id].append(arrival)
+                else:
+                    arrivals_by_stop[stop_id] = [arrival]
+
+        for arrivals in arrivals_by_stop.values():
+            arrivals.sort()
+        return cls(today, arrivals_by_stop)
+
+    def patch(self, index, changed_trip_ids, trip_ids, trip_id_to_delays):
+        """Redoes the arrivals of the trips in changed_trip_ids in place, see realtime.FeedState.apply.
+        Only the stops those trips use are touched. trip_ids is every trip in the update, a changed trip
+        which isn't in it was removed. Use build instead when the day changes"""
+        new_by_stop = {}
+        for trip_id in changed_trip_ids:
+            trip = index.trips.get(trip_id)
+            if trip is None:
+                continue
+            # the stops the trip had before, whether or not it has arrivals now
+            for stop_index in index.stop_lists[trip[3]][0]:
+                new_by_stop.setdefault(index.stop_ids[stop_index], [])
+            if trip_id in trip_ids:
+                for stop_id, arrival in trip_arrivals(index, trip_id, trip_id_to_delays, self.today):
+                    new_by_stop[stop_id].append(arrival)
+
+        for stop_id, new_arrivals in new_by_stop.items():
+            arrivals = [arrival for arrival in self.arrivals_by_stop.get(stop_id, ())
+                        if arrival[4] not in changed_trip_ids]
+            arrivals.extend(new_arrivals)
+            if len(arrivals) == 0:
+                # like build, which only has stops with arrivals
+                self.arrivals_by_stop.pop(stop_id, None)
+                self.keys.pop(stop_id, None)
+                continue
+            arrivals.sort()
+            self.arrivals_by_stop[stop_id] = arrivals
+            self.keys[stop_id] = [arrival[0] for arrival in arrivals]
+
+    def next_arrivals(self, stop_id, now_seconds, limit=None, end_seconds=None):
+        """Arrivals at stop_id predicted after now_seconds, and no later than end_seconds if given, soonest first"""
+        arrivals = self.arrivals_by_stop.get(stop_id)
+        if arrivals is None:
+            return []
+        keys = self.keys[stop_id]
+        start = bisect_right(keys, now_seconds)
+        end = len(arrivals) if end_seconds is None else bisect_right(keys, end_seconds, start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return arrivals[start:end]
+
+def trip_arrivals(index, trip_id, trip_id_to_delays, today):
+    """Yields (stop_id, arrival) for each stop of trip_id, nothing if it isn't in the schedule or isn't running today.
+    Times are seconds since midnight today. If the trip's service ran yesterday, its stops after midnight are
+    yielded too, moved back a day, see services.service_days"""
+    trip = index.trips.get(trip_id)
+    if trip is None:
+        return
+    route_index, service_index, arrival_id, stop_list_id, offset = trip
+    days = [shift for day, shift in service_days(today) if index.is_running(service_index, day)]
+    if len(days) == 0:
+        return
+    route_id = index.route_ids[route_index]
+    stop_indexes, sequences = index.stop_lists[stop_list_id]
+    delays = trip_id_to_delays.get(trip_id)
+    if delays is not None:
+        stop_delays = delays.delays_for(sequences)
+    else:
+        stop_delays = [0] * len(sequences)
+
+    for stop_index, sequence, arrival_seconds, current_delay in zip(
+            stop_indexes, sequences, index.arrivals[arrival_id], stop_delays):
+        for shift in days:
+            scheduled = offset + arrival_seconds
+            if scheduled < shift:
+                continue
+            scheduled -= shift
+            yield index.stop_ids[stop_index], (scheduled + current_delay, scheduled, current_delay, route_id, trip_id, sequence)
+
+def arrival_to_json(arrival):
+    predicted, scheduled, delay, route_id, trip_id, sequence = arrival
+    return {
+        "route_id": route_id,
+        "trip_id": trip_id,
+        "stop_sequence": sequence,
+        "scheduled": time_to_string(scheduled),
+        "predicted": time_to_string(predicted),
+        "scheduled_seconds": scheduled,
+        "predicted_seconds": predicted,
+        "delay": delay,
+    }
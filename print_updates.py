@@ -1,101 +1,58 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import heapq
+import json
+import math
 import sqlite3
-import gtfs_realtime_pb2
-from collections import defaultdict
-from operator import itemgetter
+import sys
+from collections import OrderedDict
 from datetime import datetime
+from feed_client import (
+    DEFAULT_MAX_BACKOFF,
+    DEFAULT_TIMEOUT,
+    FeedPoller,
+    check_feeds,
+    make_sources,
+)
+from predictions import arrival_to_json
+from realtime import (
+    MBTA_FEED_URL,
+    FeedState,
+    combine_states,
+    parse_message,
+)
 from schedules import time_to_string
-from box import Box
-
-
-from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
-from twisted.web.client import getPage
-
-def escaped(s):
-    return s.replace("'", "''")
-
-@inlineCallbacks
-def print_updates(args):
-    data = yield getPage("http://developer.mbta.com/lib/gtrtfs/Passages.pb")
-    update = gtfs_realtime_pb2.FeedMessage()
-    update.ParseFromString(data)
-
-    trip_id_to_delays = defaultdict(list)
-    trip_ids = set()
-    for entity in update.entity:
-        trip_id = str(entity.trip_update.trip.trip_id)
-        trip_ids.add(trip_id)
-        for stop_time_update in entity.trip_update.stop_time_update:
-            # TODO: error-check for lack of arrival.delay
-            tup = stop_time_update.stop_sequence, stop_time_update.arrival.delay
-            trip_id_to_delays[trip_id].append(tup)
-        if trip_id in trip_id_to_delays:
-            trip_id_to_delays[trip_id] = sorted(trip_id_to_delays[trip_id], key=itemgetter(0))
-
-
-
-    con = sqlite3.connect(args.db)
-    cur = con.cursor()
-    # injection risk here! SQLite can't handle this many parameters, though
-    trip_ids_str = ", ".join(("'%s'" % escaped(x)) for x in trip_ids)
-
-    query = ('SELECT stop_times.offset, arrivals.blob, '
-             'trip_ids.route_id, trip_ids.trip_id, trip_stops.blob '
-             'FROM trip_ids '
-             'JOIN stop_times ON stop_times.trip_id = trip_ids.id AND trip_ids.trip_id IN (%s) '
-             'JOIN arrivals ON arrivals.id = stop_times.arrival_id '
-             'JOIN trip_stops ON trip_stops.id = stop_times.stop_list_id ') % trip_ids_str
-    results = cur.execute(query)
-
-    stop_results = defaultdict(list)
-
-    for offset, arrivals_blob_str, route_id, trip_id, stop_list_blob_str in results:
-        trip_id = str(trip_id)
-
-        arrivals_blob = Box(arrivals_blob_str)
-        arrivals_len = arrivals_blob.read_short()
-
-        stop_list_blob = Box(stop_list_blob_str)
-        stop_list_len = stop_list_blob.read_short()
-
-        for i in xrange(arrivals_len):
-            current_delay = 0
-            stop_id = stop_list_blob.read_string()
-            sequence_id = stop_list_blob.read_short()
-            arrival_minutes = arrivals_blob.read_short()
-
-            if trip_id in trip_id_to_delays[trip_id]:
-                for stop_sequence, delay in trip_id_to_delays[trip_id]:
-                    if stop_sequence > sequence_id:
-                        break
-                    current_delay = delay
-
-            arrival_seconds = arrival_minutes * 60
-            tup = (offset + arrival_seconds, route_id, current_delay, trip_id, sequence_id)
-            stop_results[stop_id].append(tup)
-
-
-    now = datetime.now()
-    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    now_seconds = (now - midnight).seconds
-
-    if args.stop_id in stop_results:
-        lst = stop_results[args.stop_id]
-        new_lst = [(seconds, route_id, delay, trip_id, sequence_id)
-                   for (seconds, route_id, delay, trip_id, sequence_id) in lst
-                   if (seconds + delay) > now_seconds]
-
-        new_lst = sorted(new_lst, key=lambda x: x[0] + x[2])
+from stop_queries import (
+    DEFAULT_PATTERN_CACHE_SIZE,
+    PatternCache,
+    find_boards,
+    load_string_ids,
+    update_boards,
+)
+
+def upcoming(lst, now_seconds, limit=None):
+    """Arrivals which haven't happened yet, soonest first. With a limit only the first limit are kept,
+    picked with a heap of that size instead of sorting all of them"""
+    new_lst = [(seconds, route_id, delay, trip_id, sequence_id)
+               for (seconds, route_id, delay, trip_id, sequence_id) in lst
+               if (seconds + delay) > now_seconds]
+
+    if limit is not None:
+        return heapq.nsmallest(limit, new_lst, key=lambda x: x[0] + x[2])
+    return sorted(new_lst, key=lambda x: x[0] + x[2])
+
+def print_board(stop_id, lst, now_seconds, limit=None):
+    if len(lst) > 0:
+        new_lst = upcoming(lst, now_seconds, limit)
 
         if len(new_lst) == 0:
-            print("No arrivals for %s" % args.stop_id)
+            print("No arrivals for %s" % stop_id)
         else:
             for seconds, route_id, delay, trip_id, sequence_id in new_lst:
                 print("Next arrival for stop %s (sequence %d) on"
-                      " route %s is at %s with delay %d (total %s) on trip %s" % (args.stop_id,
+                      " route %s is at %s with delay %d (total %s) on trip %s" % (stop_id,
                                                                        sequence_id,
                                                                        route_id,
                                                                        time_to_string(seconds),
@@ -103,19 +60,156 @@ def print_updates(args):
                                                                        time_to_string(seconds + delay),
                                                                        trip_id))
     else:
-        print("%s is not in any of the trips specified by the SQL query" % args.stop_id)
-
-@inlineCallbacks
-def main(args):
+        print("%s is not in any of the trips specified by the SQL query" % stop_id)
+
+def print_board_json(stop_id, lst, now_seconds, limit=None):
+    """One line of JSON per stop, with the same fields as prediction_server.py"""
+    arrivals = [arrival_to_json((seconds + delay, seconds, delay, route_id, trip_id, sequence_id))
+                for seconds, route_id, delay, trip_id, sequence_id in upcoming(lst, now_seconds, limit)]
+    print(json.dumps({"stop_id": stop_id, "arrivals": arrivals}))
+
+def read_stop_ids(args):
+    """Stop ids from the command line followed by the ones in --stops-file, one per line"""
+    stop_ids = list(args.stop_ids)
+    if args.stops_file is not None:
+        with open(args.stops_file) as f:
+            stop_ids.extend(line.strip() for line in f if line.strip())
+    # keep the first of any duplicates
+    return list(OrderedDict.fromkeys(stop_ids))
+
+class Boards:
+    """The boards for every stop, kept up to date as each source's feed comes in"""
+    def __init__(self, args, cur, sources):
+        self.args = args
+        self.cur = cur
+        self.stop_ids = read_stop_ids(args)
+        self.route_ids = load_string_ids(cur, "route_ids", "route_id")
+        self.patterns = PatternCache(args.pattern_cache_size)
+        self.states = [(source, FeedState()) for source in sources]
+        self.boards = None
+        self.day = None
+        # trips which changed since the boards were last looked up
+        self.changed = set()
+        self.printed = False
+
+    def apply(self, source, message):
+        for state_source, state in self.states:
+            if state_source is source:
+                self.changed |= state.apply_message(message)
+
+    def trips(self):
+        """(trip_ids, trip_id_to_delays) from every source, see realtime.combine_states"""
+        return combine_states([state for source, state in self.states])
+
+    def refresh(self):
+        """Looks up the boards again, only for the trips which changed if it can"""
+        args = self.args
+        trip_ids, trip_id_to_delays = self.trips()
+        now = datetime.now()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        now_seconds = (now - midnight).seconds
+        if args.window is not None:
+            # the window moves with the clock, so every poll looks up every trip again
+            self.day = now.date()
+            window = now_seconds, now_seconds + int(args.window * 60)
+            self.boards = find_boards(self.cur, self.stop_ids, trip_ids, trip_id_to_delays, self.day, self.route_ids,
+                                      self.patterns, window)
+        elif self.boards is None or now.date() != self.day:
+            self.day = now.date()
+            self.boards = find_boards(self.cur, self.stop_ids, trip_ids, trip_id_to_delays, self.day, self.route_ids,
+                                      self.patterns)
+        else:
+            # with --watch, only the trips which changed since the last poll are looked up again
+            update_boards(self.cur, self.boards, self.changed, trip_ids, trip_id_to_delays, self.day, self.route_ids,
+                          self.patterns)
+        self.changed = set()
+        if args.pattern_stats:
+            sys.stderr.write("Pattern cache: %s\n" % self.patterns.stats())
+        return now_seconds
+
+    def print_boards(self):
+        args = self.args
+        now_seconds = self.refresh()
+        if self.printed and not args.json:
+            print("")
+        self.printed = True
+        for stop_id in self.stop_ids:
+            lst = self.boards[stop_id]
+            if args.json:
+                print_board_json(stop_id, lst, now_seconds, args.limit)
+            elif args.window is not None and len(lst) == 0:
+                print("No arrivals for %s in the next %g minutes" % (stop_id, args.window))
+            else:
+                print_board(stop_id, lst, now_seconds, args.limit)
+        sys.stdout.flush()
+
+def print_error(source, e):
+    sys.stderr.write("Error polling %s: %s\n" % (source.url, str(e) or e.__class__.__name__))
+
+async def print_updates(args):
+    sources = make_sources(args.feed or [[MBTA_FEED_URL]], args.watch, args.timeout)
+    con = sqlite3.connect(args.db)
+    boards = Boards(args, con.cursor(), sources)
+
+    if args.watch is None:
+        poller = FeedPoller(sources, parse_message, boards.apply, print_error)
+        try:
+            if await poller.poll_all() == 0:
+                raise Exception("No feed could be read")
+        finally:
+            poller.close()
+        boards.print_boards()
+        return
+
+    def print_stats(source):
+        if args.feed_stats:
+            sys.stderr.write("Feed %s: %s\n" % (source.url, source.stats()))
+
+    def on_update(source, message):
+        boards.apply(source, message)
+        boards.print_boards()
+    # an unchanged feed skips the decode, the SQLite join and printing the boards again
+    poller = FeedPoller(sources, parse_message, on_update, print_error, max_backoff=args.max_backoff,
+                        on_polled=print_stats)
     try:
-        yield print_updates(args)
+        await poller.run()
     finally:
-        reactor.stop()
+        poller.close()
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Print next update for a stop')
+    parser = argparse.ArgumentParser(description='Print next updates for one or more stops')
     parser.add_argument("db", help="Path to sqlite3 database generated by make_database.py")
-    parser.add_argument("stop_id", help="stop id to get results for")
+    parser.add_argument("stop_ids", nargs="*", metavar="stop_id", help="stop ids to get results for")
+    parser.add_argument("--stops-file", help="File with more stop ids to get results for, one per line")
+    parser.add_argument("--json", action="store_true", help="Print a line of JSON for each stop")
+    parser.add_argument("--feed", action="append", nargs="+", metavar="URL [SECONDS]",
+                        help="URL of a GTFS-realtime feed, or a file to read it from instead. Give it more than once "
+                             "to use several feeds. With --watch SECONDS is how often to poll this one. "
+                             "Defaults to the MBTA's feed")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Seconds to wait for each feed")
+    parser.add_argument("--max-backoff", type=float, default=DEFAULT_MAX_BACKOFF,
+                        help="With --watch, the longest to wait before polling a feed again after errors")
+    parser.add_argument("--window", type=float, metavar="MINUTES",
+                        help="Only show arrivals predicted in the next MINUTES, trips which can't arrive "
+                             "in time are skipped before their patterns are decoded")
+    parser.add_argument("--limit", type=int, metavar="K", help="Only show the next K arrivals at each stop")
+    parser.add_argument("--pattern-cache-size", type=int, default=DEFAULT_PATTERN_CACHE_SIZE,
+                        help="How many decoded arrivals and trip_stops patterns to keep between polls")
+    parser.add_argument("--pattern-stats", action="store_true",
+                        help="Print the pattern cache's hits and misses to stderr after each poll")
+    parser.add_argument("--feed-stats", action="store_true",
+                        help="With --watch, print how many polls of each feed were processed or skipped because "
+                             "the feed hadn't changed to stderr after each poll")
+    parser.add_argument("--watch", type=float, metavar="SECONDS",
+                        help="Keep polling the feeds every SECONDS and print the boards again after each poll")
     args = parser.parse_args()
-    reactor.callLater(0, lambda: main(args))
-    reactor.run()
+    if len(args.stop_ids) == 0 and args.stops_file is None:
+        parser.error("give at least one stop_id or --stops-file")
+    if args.window is not None and not math.isfinite(args.window):
+        parser.error("--window must be a finite number of minutes")
+    check_feeds(parser, args.feed)
+    try:
+        asyncio.run(print_updates(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,146 @@
+__author__ = 'schneg'
+
+import cProfile
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is left out of the report
+    resource = None
+
+REPORT_VERSION = 1
+
+def peak_rss_kb():
+    """Returns (peak RSS of this process, peak RSS of the largest finished child process) in KiB,
+    or (None, None) if the resource module isn't available"""
+    if resource is None:
+        return None, None
+    scale = 1024 if sys.platform == "darwin" else 1
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+def children_cpu_seconds():
+    """CPU time of finished worker processes, like the ones chunked_reader.iter_runs starts"""
+    times = os.times()
+    return times.children_user + times.children_system
+
+def cprofile_hook(phase_name, stats_path):
+    """Returns a hook which runs cProfile over one phase and writes the stats to stats_path,
+    to be read with pstats or snakeviz"""
+    def hook(name):
+        if name != phase_name:
+            return None
+        return _cprofile(stats_path)
+    return hook
+
+@contextmanager
+def _cprofile(stats_path):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(stats_path)
+
+class BuildProfile:
+    """Records wall and CPU time, row counts and memory for each phase of a build.
+
+    Phases are timed with the phase context manager. Timing is cheap so this is always on and
+    the report is only written if asked for. tracemalloc slows everything down a lot, so the
+    Python heap high-water mark is only recorded with trace_memory=True.
+
+    A hook is a function which is given the name of each phase as it starts and returns a context
+    manager to run around it, or None. cprofile_hook is one, a sampling profiler can be attached
+    to a single phase the same way.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.hooks = []
+        self.phases = []
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def phase(self, name, count_rows=None):
+        """Yields the phase's record, a dict. Set record["rows"] or other counts inside the block.
+        If count_rows is given it's called before and after the phase and the difference is recorded as rows,
+        for example lambda: writer.rows_written"""
+        record = {"name": name}
+        rows_before = count_rows() if count_rows is not None else None
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        with ExitStack() as stack:
+            for hook in self.hooks:
+                manager = hook(name)
+                if manager is not None:
+                    stack.enter_context(manager)
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            start_children_cpu = children_cpu_seconds()
+            yield record
+            record["wall_seconds"] = time.perf_counter() - start_wall
+            record["cpu_seconds"] = time.process_time() - start_cpu
+            record["children_cpu_seconds"] = children_cpu_seconds() - start_children_cpu
+
+        if rows_before is not None:
+            record["rows"] = count_rows() - rows_before
+        record["peak_rss_kb"], record["children_peak_rss_kb"] = peak_rss_kb()
+        if self.trace_memory:
+            record["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        self.phases.append(record)
+
+    def report(self):
+        peak_rss, children_peak_rss = peak_rss_kb()
+        ret = {
+            "version": REPORT_VERSION,
+            "argv": sys.argv,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "wall_seconds": time.perf_counter() - self.start_wall,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            "children_cpu_seconds": children_cpu_seconds(),
+            "peak_rss_kb": peak_rss,
+            "children_peak_rss_kb": children_peak_rss,
+            "phases": self.phases,
+        }
+        if self.trace_memory:
+            ret["tracemalloc_peak_bytes"] = max([phase["tracemalloc_peak_bytes"] for phase in self.phases] or [0])
+        return ret
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+
+def add_profile_arguments(parser):
+    """Adds --profile, --trace-memory and --cprofile to an argparse parser"""
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='Write a JSON report with the time, row counts and memory of each phase to REPORT')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also record the Python heap high-water mark of each phase with tracemalloc. '
+                             'This makes the build much slower')
+    parser.add_argument('--cprofile', nargs=2, metavar=('PHASE', 'STATS_FILE'),
+                        help='Run cProfile over one phase and write the stats to STATS_FILE')
+
+def profile_from_args(args):
+    profile = BuildProfile(trace_memory=args.trace_memory)
+    if args.cprofile is not None:
+        profile.add_hook(cprofile_hook(*args.cprofile))
+    return profile
+
+def finish_profile(profile, args):
+    if args.profile is not None:
+        profile.write(args.profile)
@@ -0,0 +1,174 @@
+__author__ = 'schneg'
+
+import gtfs_realtime_pb2
+import hashlib
+from box import Box
+from collections import defaultdict
+from delays import TripDelays
+
+# Reading GTFS-realtime trip updates, shared by print_updates.py and prediction_server.py.
+# Fetching is up to the caller, see feed_client.py
+
+MBTA_FEED_URL = "http://developer.mbta.com/lib/gtrtfs/Passages.pb"
+
+def is_url(source):
+    return source.startswith("http://") or source.startswith("https://")
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def parse_message(data):
+    """Returns the FeedMessage for serialized data. This is the slow part of reading a feed and doesn't
+    touch any state, so it can run in a worker"""
+    update = gtfs_realtime_pb2.FeedMessage()
+    update.ParseFromString(data)
+    return update
+
+# the key of FeedMessage.header, field 1 with wire type 2 (length delimited)
+HEADER_KEY = 0x0a
+
+def feed_timestamp(data):
+    """FeedHeader.timestamp of a serialized FeedMessage, only parsing the header. None if there isn't one,
+    or if the header isn't the first field like every producer writes it"""
+    box = Box(data)
+    if len(data) == 0 or box.read_byte() != HEADER_KEY:
+        return None
+    length = box.read_varint()
+    header = gtfs_realtime_pb2.FeedHeader()
+    header.ParseFromString(bytes(data[box.pos:box.pos + length]))
+    return header.timestamp or None
+
+class FeedVersion:
+    """Recognizes a serialized feed which is the same snapshot as the last one processed, by a hash of its bytes
+    or by FeedHeader.timestamp, before ParseFromString is called on it"""
+    def __init__(self):
+        self.digest = None
+        self.timestamp = None
+
+    def check(self, data):
+        """Returns (unchanged, version). Pass version to accept once the feed has been processed,
+        so a feed which failed isn't skipped next time"""
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        timestamp = feed_timestamp(data)
+        unchanged = digest == self.digest or (timestamp is not None and timestamp == self.timestamp)
+        return unchanged, (digest, timestamp)
+
+    def accept(self, version):
+        self.digest, self.timestamp = version
+
+# stop_time_updates with these don't say anything about the delay at the stop
+SKIPPED_RELATIONSHIPS = (gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED,
+                         gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.NO_DATA)
+
+def read_delay(stop_time_update):
+    """The arrival delay of a stop_time_update, or the departure delay if there's no arrival one.
+    None if it has neither, for example if it only has absolute times"""
+    for name in ("arrival", "departure"):
+        if stop_time_update.HasField(name):
+            event = getattr(stop_time_update, name)
+            if event.HasField("delay"):
+                return event.delay
+    return None
+
+def read_updates(trip_update):
+    """Returns [(stop_sequence, delay)] for the stop_time_updates of trip_update which have a delay.
+    SKIPPED and NO_DATA stops and updates without a delay are left out, so the delay from the stop before
+    carries on past them instead of being reset to 0, see delays.TripDelays"""
+    ret = []
+    for stop_time_update in trip_update.stop_time_update:
+        if stop_time_update.schedule_relationship in SKIPPED_RELATIONSHIPS:
+            continue
+        delay = read_delay(stop_time_update)
+        if delay is not None:
+            ret.append((stop_time_update.stop_sequence, delay))
+    return ret
+
+class FeedState:
+    """The trip updates from every feed message so far, kept between polls so only the entities which were added,
+    changed or removed are decoded again. An entity is compared to the last poll by a hash of its serialized bytes.
+
+    A FULL_DATASET message replaces everything, so entities missing from it are removed. A DIFFERENTIAL message
+    only has the entities which changed, and removes the ones with is_deleted set
+    """
+    def __init__(self):
+        # entity id -> (fingerprint, trip_id, [(stop_sequence, delay)])
+        self.entities = {}
+        # trip_id -> entity ids, almost always one
+        self.trip_entities = defaultdict(list)
+        self.trip_ids = set()
+        self.trip_id_to_delays = {}
+        self.messages = 0
+        self.entities_decoded = 0
+
+    def remove(self, entity_id, changed):
+        fingerprint, trip_id, updates = self.entities.pop(entity_id)
+        self.trip_entities[trip_id].remove(entity_id)
+        changed.add(trip_id)
+
+    def apply(self, data):
+        """Updates the state from a serialized FeedMessage, see apply_message"""
+        return self.apply_message(parse_message(data))
+
+    def apply_message(self, update):
+        """Updates the state from a parsed FeedMessage. Returns the set of trip_ids whose updates were
+        added, changed or removed, trip_ids and trip_id_to_delays are up to date afterwards.
+        Entities without a trip_update, like vehicle positions and alerts, are ignored"""
+        differential = update.header.incrementality == gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+        self.messages += 1
+
+        changed = set()
+        seen = set()
+        for position, entity in enumerate(update.entity):
+            # id is required, but fall back to the position rather than merging entities without one
+            entity_id = entity.id or "#%d" % position
+            seen.add(entity_id)
+            if entity.is_deleted or not entity.HasField("trip_update"):
+                if entity_id in self.entities:
+                    self.remove(entity_id, changed)
+                continue
+
+            fingerprint = hashlib.blake2b(entity.SerializeToString(), digest_size=16).digest()
+            old = self.entities.get(entity_id)
+            if old is not None and old[0] == fingerprint:
+                continue
+            if old is not None:
+                self.remove(entity_id, changed)
+            trip_id = str(entity.trip_update.trip.trip_id)
+            self.entities[entity_id] = (fingerprint, trip_id, read_updates(entity.trip_update))
+            self.trip_entities[trip_id].append(entity_id)
+            self.entities_decoded += 1
+            changed.add(trip_id)
+
+        if not differential:
+            for entity_id in [entity_id for entity_id in self.entities if entity_id not in seen]:
+                self.remove(entity_id, changed)
+
+        for trip_id in changed:
+            entity_ids = self.trip_entities[trip_id]
+            if len(entity_ids) == 0:
+                del self.trip_entities[trip_id]
+                self.trip_ids.discard(trip_id)
+                self.trip_id_to_delays.pop(trip_id, None)
+                continue
+            self.trip_ids.add(trip_id)
+            updates = []
+            for entity_id in entity_ids:
+                updates.extend(self.entities[entity_id][2])
+            if len(updates) > 0:
+                self.trip_id_to_delays[trip_id] = TripDelays(updates)
+            else:
+                self.trip_id_to_delays.pop(trip_id, None)
+        return changed
+
+def combine_states(states):
+    """(trip_ids, trip_id_to_delays) from several FeedStates, one per feed. When two feeds have the same trip
+    the later one wins"""
+    if len(states) == 1:
+        return states[0].trip_ids, states[0].trip_id_to_delays
+    trip_ids = set()
+    trip_id_to_delays = {}
+    for state in states:
+        trip_ids |= state.trip_ids
+        trip_id_to_delays.update(state.trip_id_to_delays)
+    return trip_ids, trip_id_to_delays
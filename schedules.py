@@ -136,10 +136,10 @@ class StopSchedule:
 def time_to_string(time):
     """Seconds from beginning of day to string"""
 
-    hour = time / (60*60)
+    hour = time // (60*60)
     time -= hour*60*60
 
-    minute = time/60
+    minute = time // 60
     time -= minute*60
 
     second = time
@@ -0,0 +1,119 @@
+__author__ = 'schneg'
+
+import os
+from datetime import date, timedelta
+
+from feed_files import feed_file_exists
+from parse_cache import read_csv_table
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+SECONDS_PER_DAY = 24*60*60
+
+_parsed_dates = {}
+def parse_date(s):
+    """Parses a GTFS YYYYMMDD date. There are only a few hundred distinct dates in a feed so these are memoized"""
+    ret = _parsed_dates.get(s)
+    if ret is None:
+        ret = date(int(s[0:4]), int(s[4:6]), int(s[6:8]))
+        _parsed_dates[s] = ret
+    return ret
+
+def format_date(d):
+    return d.strftime("%Y%m%d")
+
+def service_days(today):
+    """Returns (date, seconds) for each service day which can have trips running today. GTFS times go past
+    24:00:00 for trips which run after midnight, so yesterday's trips can still be running. seconds is what
+    to subtract from a time on that day's schedule to get seconds since midnight today"""
+    return [(today, 0), (today - timedelta(days=1), SECONDS_PER_DAY)]
+
+def read_rows(path, cache=None):
+    """Returns a dict for each row like csv.DictReader, or an empty list if the file doesn't exist"""
+    if not feed_file_exists(path):
+        return []
+    header, rows = read_csv_table(path, cache)
+    return [dict(zip(header, row)) for row in rows]
+
+class ServiceCalendar:
+    """Which services run on which days.
+
+    Each service has a bitset as an int where bit i is set if the service runs on start_date + i days,
+    with calendar_dates.txt exceptions already applied
+    """
+    def __init__(self, start_date, num_days, bits):
+        self.start_date = start_date
+        self.num_days = num_days
+        # service_id -> int bitset
+        self.bits = bits
+        # date -> set of service_ids, filled in by active_services
+        self._active = {}
+
+    @classmethod
+    def from_gtfs(cls, path, cache=None):
+        """Reads calendar.txt and calendar_dates.txt in the GTFS directory or zip, either of which may be missing"""
+        calendar = read_rows(os.path.join(path, "calendar.txt"), cache)
+        calendar_dates = read_rows(os.path.join(path, "calendar_dates.txt"), cache)
+
+        all_dates = [parse_date(row[key]) for row in calendar for key in ("start_date", "end_date")]
+        all_dates += [parse_date(row["date"]) for row in calendar_dates]
+        if len(all_dates) == 0:
+            return cls(None, 0, {})
+        start_date = min(all_dates)
+        num_days = (max(all_dates) - start_date).days + 1
+
+        bits = {}
+        for row in calendar:
+            weekdays = [row[day] == "1" for day in WEEKDAYS]
+            first = (parse_date(row["start_date"]) - start_date).days
+            last = (parse_date(row["end_date"]) - start_date).days
+            service_bits = 0
+            for i in range(first, last + 1):
+                if weekdays[(start_date + timedelta(days=i)).weekday()]:
+                    service_bits |= 1 << i
+            bits[row["service_id"]] = service_bits
+
+        for row in calendar_dates:
+            service_id = row["service_id"]
+            i = (parse_date(row["date"]) - start_date).days
+            service_bits = bits.get(service_id, 0)
+            if row["exception_type"] == "1":
+                service_bits |= 1 << i
+            elif row["exception_type"] == "2":
+                service_bits &= ~(1 << i)
+            else:
+                raise Exception("Unknown exception_type %s for service %s" % (row["exception_type"], service_id))
+            bits[service_id] = service_bits
+
+        return cls(start_date, num_days, bits)
+
+    def to_bytes(self, service_id):
+        return self.bits.get(service_id, 0).to_bytes((self.num_days + 7) // 8, 'little')
+
+    @classmethod
+    def from_rows(cls, rows):
+        """rows is (id, start_date, days) from the services table, so services are keyed by their id"""
+        start_date = None
+        num_days = 0
+        bits = {}
+        for service_id, start_date_str, blob in rows:
+            start_date = parse_date(str(start_date_str))
+            num_days = max(num_days, len(blob) * 8)
+            bits[service_id] = int.from_bytes(bytes(blob), 'little')
+        return cls(start_date, num_days, bits)
+
+    def is_active(self, service_id, d):
+        if self.start_date is None:
+            return False
+        i = (d - self.start_date).days
+        if i < 0 or i >= self.num_days:
+            return False
+        return (self.bits.get(service_id, 0) >> i) & 1 == 1
+
+    def active_services(self, d):
+        """Returns the set of service_ids which run on date d"""
+        ret = self._active.get(d)
+        if ret is None:
+            ret = set(service_id for service_id in self.bits if self.is_active(service_id, d))
+            self._active[d] = ret
+        return ret
@@ -0,0 +1,275 @@
+__author__ = 'schneg'
+
+from array import array
+from collections import OrderedDict
+from blobs import (
+    decode_arrivals,
+    decode_stop_list,
+)
+from services import (
+    ServiceCalendar,
+    service_days,
+)
+
+# The database side of print_updates.py. This doesn't need protobuf or Twisted so it can be used by the benchmarks
+
+DEFAULT_PATTERN_CACHE_SIZE = 4096
+
+class PatternCache:
+    """A bounded LRU cache of decoded arrivals and trip_stops blobs from one database, keyed by table and id.
+
+    Many trips share a pattern, so keeping one of these across find_boards calls means a pattern is only
+    decoded again after it falls out of the cache. hits and misses count lookups, for sizing max_size
+    """
+    def __init__(self, max_size=DEFAULT_PATTERN_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, cur, table, pattern_id):
+        key = table, pattern_id
+        entries = self.entries
+        value = entries.get(key)
+        if value is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return value
+
+        self.misses += 1
+        blob = cur.execute("SELECT blob FROM %s WHERE id = ?" % table, (pattern_id,)).fetchone()[0]
+        if table == "arrivals":
+            value = array('i', decode_arrivals(blob)[0])
+        else:
+            indexes, sequences = decode_stop_list(blob)
+            value = array('i', indexes), array('i', sequences)
+        entries[key] = value
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+        return value
+
+    def arrivals(self, cur, arrival_id):
+        """Arrivals in seconds from the start of the trip"""
+        return self.get(cur, "arrivals", arrival_id)
+
+    def stop_list(self, cur, stop_list_id):
+        """(stop indexes, sequences)"""
+        return self.get(cur, "trip_stops", stop_list_id)
+
+    def stats(self):
+        return "%d hits, %d misses, %d of %d entries" % (self.hits, self.misses, len(self.entries), self.max_size)
+
+def load_string_ids(cur, table, column):
+    """Returns a list of the strings in stop_ids or route_ids, indexed by id"""
+    rows = cur.execute("SELECT id, %s FROM %s" % (column, table)).fetchall()
+    ret = [None] * (max(index for index, s in rows) + 1 if rows else 0)
+    for index, s in rows:
+        ret[index] = str(s)
+    return ret
+
+def delay_bounds(trip_id_to_delays):
+    """(smallest, largest) delay in the update, counting the 0 before a trip's first stop_time_update"""
+    smallest = 0
+    largest = 0
+    for delays in trip_id_to_delays.values():
+        if len(delays) > 0:
+            smallest = min(smallest, min(delays.delays))
+            largest = max(largest, max(delays.delays))
+    return smallest, largest
+
+TRIP_START = 'stop_times.offset + (trip_ids.id - stop_times.trip_id) * stop_times.headway'
+TRIP_END = TRIP_START + ' + (SELECT duration FROM arrivals WHERE arrivals.id = stop_times.arrival_id)'
+
+def has_durations(cur):
+    """Databases made before arrivals.duration was added don't have it"""
+    return "duration" in [row[1] for row in cur.execute("PRAGMA table_info(arrivals)")]
+
+def window_filter(window, bounds, durations):
+    """Returns (list of SQL conditions on the trip_ids join, parameters) which skip trips that can't have a predicted
+    arrival in window, (start seconds, end seconds). A trip's stops are scheduled between its start and its start plus
+    arrivals.duration, and any delay in the update could move them. bounds is delay_bounds for the update.
+    Databases made before arrivals.duration was added, which have durations False, only skip trips which
+    start too late"""
+    start_seconds, end_seconds = window
+    smallest_delay, largest_delay = bounds
+    conditions = ['%s <= ?' % TRIP_START]
+    params = [end_seconds - smallest_delay]
+    if durations:
+        conditions.append('%s > ?' % TRIP_END)
+        params.append(start_seconds - largest_delay)
+    return conditions, params
+
+def service_filter(cur, calendar, today, window, trip_id_to_delays):
+    """Returns (SQL to add to the trip_ids join, parameters) which skips trips not running today, before anything
+    is decoded. Those are trips whose service doesn't run today, unless it ran yesterday and the trip is still going
+    after midnight, see services.service_days. With a window, see find_boards, trips which can't have an arrival
+    in it are skipped too"""
+    durations = has_durations(cur)
+    bounds = delay_bounds(trip_id_to_delays) if window is not None else None
+    terms = []
+    params = []
+    for day, shift in service_days(today):
+        conditions = []
+        if calendar.start_date is not None:
+            # the unary + stops SQLite from building an automatic index on service_id instead of using the id range
+            conditions.append('+trip_ids.service_id IN (%s)' % ", ".join(
+                str(service_id) for service_id in sorted(calendar.active_services(day))))
+        if shift > 0 and durations:
+            conditions.append('%s >= %d' % (TRIP_END, shift))
+        if window is not None:
+            # yesterday's schedule is a day ahead of today's clock
+            window_conditions, window_params = window_filter((window[0] + shift, window[1] + shift), bounds,
+                                                             durations)
+            conditions.extend(window_conditions)
+            params.extend(window_params)
+        if len(conditions) == 0:
+            # no calendar in the feed and no window, every trip is running
+            return '', []
+        terms.append(" AND ".join(conditions))
+    return 'AND ((%s)) ' % ") OR (".join(terms), params
+
+def read_board_rows(cur, query, trip_id_to_delays, today, route_ids, patterns, window):
+    """Runs query, see find_boards, and yields (stop index, (seconds, route_id, delay, trip_id, sequence_id))
+    for each arrival, with seconds since midnight today. A trip whose service runs both yesterday and today
+    can be at a stop twice, once for yesterday's run if it's still going after midnight and once for today's"""
+    calendar = ServiceCalendar.from_rows(cur.execute("SELECT id, start_date, days FROM services"))
+    filter_sql, params = service_filter(cur, calendar, today, window, trip_id_to_delays)
+    # (seconds to subtract, services running that day or None if every trip runs)
+    days = [(shift, calendar.active_services(day) if calendar.start_date is not None else None)
+            for day, shift in service_days(today)]
+
+    for stop_index, position, offset, route_index, trip_id, arrival_id, stop_list_id, service_index in cur.execute(
+            query % filter_sql, params).fetchall():
+        trip_id = str(trip_id)
+        route_id = route_ids[route_index]
+        sequence_id = patterns.stop_list(cur, stop_list_id)[1][position]
+        arrival_seconds = patterns.arrivals(cur, arrival_id)[position]
+
+        delays = trip_id_to_delays.get(trip_id)
+        current_delay = delays.delay_at(sequence_id) if delays is not None else 0
+        for shift, services in days:
+            if services is not None and service_index not in services:
+                continue
+            seconds = offset + arrival_seconds - shift
+            if seconds < 0:
+                # yesterday's trip was here before midnight
+                continue
+            if window is not None and not window[0] < seconds + current_delay <= window[1]:
+                continue
+            yield stop_index, (seconds, route_id, current_delay, trip_id, sequence_id)
+
+def load_trip_ids(cur, trip_ids):
+    """Replaces the contents of the temp table realtime_trips, which find_arrivals joins against, with trip_ids.
+    The rows are inserted as parameters so there's nothing to escape"""
+    # TEXT like trip_ids.trip_id, so ids like '0070' are compared as strings and don't match '70'
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS realtime_trips (trip_id TEXT PRIMARY KEY)")
+    cur.execute("DELETE FROM realtime_trips")
+    cur.executemany("INSERT OR IGNORE INTO realtime_trips VALUES (?)", ((trip_id,) for trip_id in trip_ids))
+
+def load_board_stops(cur, stop_ids):
+    """Replaces the contents of the temp table board_stops, which find_boards joins against,
+    with the ids of the stops in stop_ids. Returns stop index -> stop_id for the ones in the database"""
+    wanted = set(stop_ids)
+    stop_indexes = {}
+    for index, stop_id in cur.execute("SELECT id, stop_id FROM stop_ids"):
+        stop_id = str(stop_id)
+        if stop_id in wanted:
+            stop_indexes[index] = stop_id
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS board_stops (stop_index INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM board_stops")
+    cur.executemany("INSERT INTO board_stops VALUES (?)", ((index,) for index in stop_indexes))
+    return stop_indexes
+
+def find_boards(cur, stop_ids, trip_ids, trip_id_to_delays, today, route_ids=None, patterns=None, window=None):
+    """Returns stop_id -> list of (seconds, route_id, delay, trip_id, sequence_id) for each trip in trip_ids
+    which stops there, for every stop in stop_ids. Stops which aren't in the database have an empty list.
+    seconds is since midnight today. Trips of yesterday's services which are still running after midnight
+    are included, with their times moved back a day.
+
+    All the stops are found with one query, and each arrivals and stop list blob is decoded once
+    no matter how many of the stops it's used for. Pass a PatternCache as patterns to keep them decoded
+    between calls.
+
+    window is (start seconds, end seconds) or None. If given only arrivals predicted after the start and no later
+    than the end are returned, and trips which can't have one are skipped in the query before anything is decoded.
+
+    trip_ids can be None to use the trips from the last load_trip_ids call, when looking up stops
+    for the same update more than once. trip_id_to_delays is trip_id -> delays.TripDelays, see realtime.FeedState.apply.
+    route_ids is the list from load_string_ids, pass it in when calling this more than once
+    """
+    if route_ids is None:
+        route_ids = load_string_ids(cur, "route_ids", "route_id")
+    if patterns is None:
+        patterns = PatternCache()
+    if trip_ids is not None:
+        load_trip_ids(cur, trip_ids)
+    stop_indexes = load_board_stops(cur, stop_ids)
+    ret = dict((stop_id, []) for stop_id in stop_ids)
+    if len(stop_indexes) == 0:
+        return ret
+
+    # stop_patterns has each stop list containing the stops, so only trips serving them are looked at.
+    # Each stop_times row is a run of trips starting at stop_times.trip_id, see make_database.build_runs.
+    # The only thing which changes in the SQL is the service filter, which changes once a day, so sqlite3's
+    # statement cache keeps this prepared. CROSS JOIN keeps SQLite to this join order, from the few stops
+    # asked for out to their trips. Without statistics it would rather start from stop_patterns or trip_ids
+    query = ('SELECT stop_patterns.stop_id, stop_patterns.position, '
+             'stop_times.offset + (trip_ids.id - stop_times.trip_id) * stop_times.headway, '
+             'trip_ids.route_id, trip_ids.trip_id, stop_times.arrival_id, stop_times.stop_list_id, trip_ids.service_id '
+             'FROM board_stops '
+             'CROSS JOIN stop_patterns ON stop_patterns.stop_id = board_stops.stop_index '
+             'CROSS JOIN stop_times ON stop_times.stop_list_id = stop_patterns.stop_list_id '
+             'CROSS JOIN trip_ids ON trip_ids.id >= stop_times.trip_id AND trip_ids.id < stop_times.trip_id + stop_times.count '
+             '%s'
+             'CROSS JOIN realtime_trips ON realtime_trips.trip_id = trip_ids.trip_id')
+    for stop_index, tup in read_board_rows(cur, query, trip_id_to_delays, today, route_ids, patterns, window):
+        ret[stop_indexes[stop_index]].append(tup)
+    return ret
+
+def update_boards(cur, boards, changed_trip_ids, trip_ids, trip_id_to_delays, today, route_ids=None, patterns=None):
+    """Patches boards from an earlier find_boards call for the same day in place, when only the trips in
+    changed_trip_ids were added, changed or removed, see realtime.FeedState.apply. Only those trips are joined
+    against the database again. trip_ids is every trip in the update. Leaves realtime_trips with just the changed trips
+    """
+    if len(changed_trip_ids) == 0:
+        return boards
+    for lst in boards.values():
+        lst[:] = [tup for tup in lst if tup[3] not in changed_trip_ids]
+    current = changed_trip_ids & trip_ids
+    if len(current) == 0:
+        return boards
+    if route_ids is None:
+        route_ids = load_string_ids(cur, "route_ids", "route_id")
+    if patterns is None:
+        patterns = PatternCache()
+    load_trip_ids(cur, current)
+    stop_indexes = load_board_stops(cur, list(boards))
+    if len(stop_indexes) == 0:
+        return boards
+
+    # The other way around from find_boards, there are only a few changed trips so this starts from them.
+    # Each trip is found through the trip_ids_trip_id index, then its run is the stop_times row with the largest
+    # trip_id no bigger than the trip's id, which SQLite finds with one seek on the primary key. The stops asked for
+    # are looked up in stop_patterns for the run's stop list
+    query = ('SELECT stop_patterns.stop_id, stop_patterns.position, '
+             'stop_times.offset + (trip_ids.id - stop_times.trip_id) * stop_times.headway, '
+             'trip_ids.route_id, trip_ids.trip_id, stop_times.arrival_id, stop_times.stop_list_id, trip_ids.service_id '
+             'FROM realtime_trips '
+             'CROSS JOIN trip_ids ON trip_ids.trip_id = realtime_trips.trip_id '
+             'CROSS JOIN stop_times ON stop_times.trip_id = '
+             '(SELECT MAX(runs.trip_id) FROM stop_times AS runs WHERE runs.trip_id <= trip_ids.id) '
+             'AND trip_ids.id < stop_times.trip_id + stop_times.count '
+             '%s'
+             'CROSS JOIN board_stops '
+             'CROSS JOIN stop_patterns ON stop_patterns.stop_id = board_stops.stop_index '
+             'AND stop_patterns.stop_list_id = stop_times.stop_list_id')
+    for stop_index, tup in read_board_rows(cur, query, trip_id_to_delays, today, route_ids, patterns, None):
+        boards[stop_indexes[stop_index]].append(tup)
+    return boards
+
+def find_arrivals(cur, stop_id, trip_ids, trip_id_to_delays, today, route_ids=None, patterns=None, window=None):
+    """find_boards for one stop, returns its list"""
+    return find_boards(cur, [stop_id], trip_ids, trip_id_to_delays, today, route_ids, patterns, window)[stop_id]
@@ -0,0 +1,205 @@
+__author__ = 'schneg'
+
+import asyncio
+import unittest
+
+import gtfs_realtime_pb2
+from feed_client import (
+    FeedPoller,
+    FeedSource,
+)
+from realtime import parse_message
+
+# Tests for feed_client.py against a local asyncio server. Run with python -m unittest
+
+def make_feed(trip_ids, timestamp=1):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = "2.0"
+    message.header.timestamp = timestamp
+    for trip_id in trip_ids:
+        entity = message.entity.add()
+        entity.id = trip_id
+        entity.trip_update.trip.trip_id = trip_id
+        update = entity.trip_update.stop_time_update.add()
+        update.stop_sequence = 1
+        update.arrival.delay = 60
+    return message.SerializeToString()
+
+class StubServer:
+    """Answers every GET with respond(request headers), which returns (status, headers, body).
+    Waits delay seconds before answering, or until stop is called"""
+    def __init__(self, respond):
+        self.respond = respond
+        self.delay = 0
+        self.requests = []
+        self.server = None
+        self.stopping = asyncio.Event()
+        self.handlers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return "http://127.0.0.1:%d/feed.pb" % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.stopping.set()
+        await asyncio.gather(*self.handlers)
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        self.requests.append(headers)
+        if self.delay > 0:
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.delay)
+            except asyncio.TimeoutError:
+                pass
+        status, response_headers, body = self.respond(headers)
+        lines = ["HTTP/1.1 %d Stub" % status, "Content-Length: %d" % len(body), "Connection: close"]
+        lines.extend("%s: %s" % (name, value) for name, value in response_headers.items())
+        try:
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            # the client gave up waiting
+            pass
+        writer.close()
+        self.handlers.discard(asyncio.current_task())
+
+class FeedPollerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.status = 200
+        self.headers = {}
+        self.body = make_feed(["A", "B"])
+        self.server = StubServer(lambda request_headers: (self.status, self.headers, self.body))
+        self.url = await self.server.start()
+        self.updates = []
+        self.errors = []
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+
+    def make_poller(self, source, max_backoff=60):
+        return FeedPoller([source], parse_message, lambda source, message: self.updates.append(message),
+                          lambda source, e: self.errors.append(e), max_backoff=max_backoff)
+
+    async def test_success(self):
+        source = FeedSource(self.url, interval=10, timeout=5)
+        poller = self.make_poller(source)
+        try:
+            self.assertTrue(await poller.poll(source))
+        finally:
+            poller.close()
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual([entity.trip_update.trip.trip_id for entity in self.updates[0].entity], ["A", "B"])
+        self.assertEqual((source.polls, source.processed, source.skipped, source.errors), (1, 1, 0, 0))
+        self.assertEqual(self.errors, [])
+
+    async def test_timeout(self):
+        self.server.delay = 1
+        source = FeedSource(self.url, interval=10, timeout=0.1)
+        poller = self.make_poller(source)
+        try:
+            self.assertFalse(await poller.poll(source))
+        finally:
+            poller.close()
+        self.assertEqual(self.updates, [])
+        self.assertEqual(len(self.errors), 1)
+        self.assertIsInstance(self.errors[0], asyncio.TimeoutError)
+        self.assertEqual((source.polls, source.errors, source.failures), (0, 1, 1))
+
+    async def test_backoff(self):
+        self.status = 500
+        source = FeedSource(self.url, interval=10, timeout=5)
+        poller = self.make_poller(source, max_backoff=60)
+        delays = [source.next_delay(poller.max_backoff)]
+        try:
+            for i in range(4):
+                self.assertFalse(await poller.poll(source))
+                delays.append(source.next_delay(poller.max_backoff))
+            self.status = 200
+            self.assertTrue(await poller.poll(source))
+            delays.append(source.next_delay(poller.max_backoff))
+        finally:
+            poller.close()
+        # doubles after each failure up to max_backoff, then back to the interval once a poll works
+        self.assertEqual(delays, [10, 20, 40, 60, 60, 10])
+        self.assertEqual(source.errors, 4)
+        self.assertEqual(len(self.updates), 1)
+
+    async def test_on_polled_error(self):
+        def on_polled(source):
+            raise Exception("on_polled failed")
+        source = FeedSource(self.url, interval=10, timeout=5)
+        poller = FeedPoller([source], parse_message, lambda source, message: self.updates.append(message),
+                            lambda source, e: self.errors.append(e), on_polled=on_polled)
+        try:
+            # run_source would stop if this raised
+            self.assertFalse(await poller.poll(source))
+        finally:
+            poller.close()
+        self.assertEqual([str(e) for e in self.errors], ["on_polled failed"])
+        self.assertEqual((source.errors, source.failures), (1, 1))
+        self.assertEqual(source.next_delay(poller.max_backoff), 20)
+
+    async def poll_twice(self, change=None):
+        """Polls twice, calling change() in between. Returns the source"""
+        source = FeedSource(self.url, interval=10, timeout=5)
+        poller = self.make_poller(source)
+        try:
+            self.assertTrue(await poller.poll(source))
+            if change is not None:
+                change()
+            self.assertTrue(await poller.poll(source))
+        finally:
+            poller.close()
+        return source
+
+    async def test_not_modified(self):
+        self.headers = {"ETag": '"v1"', "Last-Modified": "Sun, 18 Oct 2026 12:00:00 GMT"}
+
+        def respond(request_headers):
+            if request_headers.get("if-none-match") == '"v1"':
+                return 304, {}, b""
+            return 200, self.headers, self.body
+        self.server.respond = respond
+        source = await self.poll_twice()
+        self.assertNotIn("if-none-match", self.server.requests[0])
+        self.assertEqual(self.server.requests[1]["if-none-match"], '"v1"')
+        self.assertEqual(self.server.requests[1]["if-modified-since"], "Sun, 18 Oct 2026 12:00:00 GMT")
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual((source.polls, source.processed, source.skipped), (2, 1, 1))
+
+    async def test_identical_bytes(self):
+        # no validators and no header timestamp, only the hash of the bytes can tell
+        self.body = make_feed(["A", "B"], timestamp=0)
+        source = await self.poll_twice()
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual((source.polls, source.processed, source.skipped), (2, 1, 1))
+
+    async def test_same_timestamp(self):
+        # different bytes, but the same FeedHeader.timestamp means the same snapshot
+        def change():
+            self.body = make_feed(["A", "B", "C"], timestamp=1)
+        source = await self.poll_twice(change)
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual((source.polls, source.processed, source.skipped), (2, 1, 1))
+
+    async def test_new_timestamp(self):
+        def change():
+            self.body = make_feed(["A", "B", "C"], timestamp=2)
+        source = await self.poll_twice(change)
+        self.assertEqual(len(self.updates), 2)
+        self.assertEqual(len(self.updates[1].entity), 3)
+        self.assertEqual((source.polls, source.processed, source.skipped), (2, 2, 0))
+
+if __name__ == "__main__":
+    unittest.main()
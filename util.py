@@ -1,4 +1,9 @@
 __author__ = 'schneg'
+
+from functools import lru_cache
+
+# A feed only has a few thousand distinct times, so this hits almost every time
+@lru_cache(maxsize=65536)
 def parse_time(s):
     """Returns seconds from beginning of day. May go into tomorrow slightly"""
     hour, minute, second = s.split(":")
@@ -13,4 +18,3 @@ def parse_time(s):
         day = 0
 
     return second + 60*minute + 60*60*hour + 24*60*60*day
-